@@ -1,5 +1,5 @@
 import os
-from pydantic import BaseModel, ConfigDict, model_validator
+from pydantic import BaseModel, ConfigDict, PositiveInt, model_validator
 from typing import Literal, Optional
 
 
@@ -7,9 +7,21 @@ class Config(BaseModel):
     model_config = ConfigDict(frozen=True)
 
     backup_cron: Optional[str] = None
+    backup_jitter: Optional[PositiveInt] = None
+    backup_spread: Optional[PositiveInt] = None
     ignore_regex: Optional[str] = "^(.*(tmp|cache).*)|[0-9a-f]{64}$"
     full_if_older_than: Optional[str] = "1M"
     passphrase: Optional[str] = None
+    backup_concurrency: PositiveInt = 1
+    skip_unchanged: bool = False
+    snapshot_volume: Optional[str] = None
+    restore_concurrency: PositiveInt = 1
+    restore_mode: Literal["wipe"] | Literal["swap"] | Literal["sync"] = "wipe"
+    api_concurrency: PositiveInt = 16
+    probe_concurrency: PositiveInt = 4
+    progress: bool = False
+    metrics_port: Optional[PositiveInt] = None
+    runner_keep_alive: Optional[PositiveInt] = None
 
     remove_older_than: Optional[str] = None
     remove_all_but_n_full: Optional[int] = None
@@ -34,6 +46,11 @@ class Config(BaseModel):
 
     s3_storage_class: Literal["STANDARD"] | Literal["STANDARD_IA"] = "STANDARD"
 
+    metadata_manifest: bool = False
+
+    # Only used inside of the control container
+    state_dir: str = "/var/lib/duplyvolume"
+
     @model_validator(mode="after")
     def validate_s3(self) -> "Config":
         if self.s3_bucket_name is not None:
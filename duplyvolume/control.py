@@ -1,41 +1,123 @@
 import logging
 import asyncio
+import re
+import shlex
+import time
 from functools import partial
+import aiodocker
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler  # type: ignore[import-untyped]
 from apscheduler.triggers.cron import CronTrigger  # type: ignore[import-untyped]
+from apscheduler.triggers.interval import IntervalTrigger  # type: ignore[import-untyped]
 
 from .config import config
+from .docker_utils import remove_kept_runners, stop_kept_runners
+from .history import install_history_handler, render_report
+from .inventory import get_inventory, watch_inventory
+from .metadata import read_manifest, record_backup_metric
+from .metrics import install_metrics_handler, record_metric, render_metrics
 from .ipc import send_command_to_control, stream_logs_to
 from .control_tasks import (
     backup_stage1,
     cancel_backup,
+    find_backup_volumes,
     healthcheck,
+    replay_journal_if_idle,
     restore_stage1,
 )
-from .utils import close_writer
+from .utils import close_writer, group_volumes
 
 logger = logging.getLogger(__name__)
 
+INTERVAL_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
+# Volumes with this label are backed up on their own schedule instead of BACKUP_CRON
+SCHEDULE_LABEL = "duplyvolume.cron"
+# Schedules of volume labels which could not be parsed, so the error is only logged once
+invalid_schedules: set[str] = set()
+
+
+def record_run(command: str, result: str):
+    record_metric(
+        "duplyvolume_runs", {"command": command, "result": result}, 1, add=True
+    )
+
+
+async def handle_metrics_request(reader, writer):
+    # Minimal HTTP server for Prometheus, it only knows GET /metrics
+    try:
+        request_line = (await reader.readline()).decode("utf-8")
+        # Skip the headers
+        while (await reader.readline()) not in {b"\r\n", b"\n", b""}:
+            pass
+        if request_line.split(" ")[:2] in (["GET", "/metrics"], ["HEAD", "/metrics"]):
+            status = "200 OK"
+            body = render_metrics().encode("utf-8")
+        else:
+            status = "404 Not Found"
+            body = b"Not Found\n"
+        writer.write(
+            (
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: application/openmetrics-text; version=1.0.0; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("utf-8")
+        )
+        if not request_line.startswith("HEAD "):
+            writer.write(body)
+    except:
+        logger.exception("Failed to answer metrics request")
+    finally:
+        await close_writer(writer)
+
+
+async def load_backup_metrics():
+    # The metrics only live in memory, start with the last backups of the manifest
+    try:
+        manifest = await read_manifest()
+    except Exception:
+        logger.warning("Failed to load the last backups for metrics", exc_info=True)
+        return
+    for volume_name, volume in manifest["volumes"].items():
+        if "last_backup" in volume:
+            record_backup_metric(volume_name, volume["last_backup"])
+
 
 async def handle_client(task_lock: asyncio.Lock, reader, writer):
     try:
-        command = (await reader.readuntil()).decode("utf-8")[0:-1]
+        # NOTE: Volume selectors are passed after the command, quoted like shell arguments
+        command, *selectors = shlex.split(
+            (await reader.readuntil()).decode("utf-8")[0:-1]
+        ) or [""]
+        # NOTE: Not inside stream_logs_to, log lines of a running backup/restore would end up in the output
+        if command == "metrics":
+            writer.write(render_metrics().encode("utf-8"))
+            return
+        if command == "report":
+            report = await asyncio.to_thread(
+                render_report, selectors[0] if len(selectors) > 0 else "backup"
+            )
+            writer.write(report.encode("utf-8"))
+            return
         with stream_logs_to(writer):
             if command == "backup":
                 logger.info("Backup requested")
                 try:
-                    await backup_stage1(task_lock)
+                    await backup_stage1(task_lock, selectors)
                     logger.info("Backup done")
+                    record_run("backup", "success")
                 except:
                     logger.exception("Backup failed")
+                    record_run("backup", "failure")
             elif command == "restore":
                 logger.info("Restore requested")
                 try:
-                    await restore_stage1(task_lock)
+                    await restore_stage1(task_lock, selectors)
                     logger.info("Restore done")
+                    record_run("restore", "success")
                 except:
                     logger.exception("Restore failed")
+                    record_run("restore", "failure")
             elif command == "cancel":
                 logger.info("Cancellation of current backup requested")
                 try:
@@ -59,31 +141,149 @@ async def handle_client(task_lock: asyncio.Lock, reader, writer):
         await close_writer(writer)
 
 
-async def scheduled_backup():
+def create_trigger(schedule: str):
+    # Either an interval like "6h" or a cron expression like "0 3 * * 0"
+    match = re.fullmatch(r"(\d+)([smhd])", schedule.strip())
+    if match is not None:
+        return IntervalTrigger(
+            **{INTERVAL_UNITS[match[2]]: int(match[1])}, jitter=config.backup_jitter
+        )
+    fields = schedule.split()
+    if len(fields) != 5:
+        raise ValueError(f"Invalid schedule '{schedule}'")
+    # NOTE: Like CronTrigger.from_crontab, which does not support jitter
+    minute, hour, day, month, day_of_week = fields
+    return CronTrigger(
+        minute=minute,
+        hour=hour,
+        day=day,
+        month=month,
+        day_of_week=day_of_week,
+        jitter=config.backup_jitter,
+    )
+
+
+async def scheduled_backup(selectors: list[str]):
     logger.info("Scheduled backup triggered")
-    await send_command_to_control("backup", silent=True)
+    if config.backup_spread is None:
+        await send_command_to_control(shlex.join(["backup", *selectors]), silent=True)
+        return
+
+    async with aiodocker.Docker() as client:
+        inventory = await get_inventory(client)
+    # Volumes which share a container are still backed up together, so every container is only stopped once
+    groups = group_volumes(
+        {
+            volume_name: volume_info["used_by_containers"]
+            for volume_name, volume_info in find_backup_volumes(
+                inventory, selectors
+            ).items()
+        }
+    )
+    logger.info(
+        f"Spreading backup of {sum(len(group) for group in groups)} volumes over {config.backup_spread}s"
+    )
+    start_time = time.monotonic()
+    for index, volume_names in enumerate(groups):
+        # NOTE: If a backup takes longer than its share of the window, the next one starts right after it
+        await asyncio.sleep(
+            start_time + config.backup_spread * index / len(groups) - time.monotonic()
+        )
+        await send_command_to_control(
+            shlex.join(["backup", *volume_names]), silent=True
+        )
+
+
+def update_volume_schedules(scheduler: AsyncIOScheduler, volumes: dict[str, dict]):
+    # Called by watch_inventory, volume labels cannot change but volumes can be created and removed at any time
+    schedules = {
+        volume["Labels"][SCHEDULE_LABEL]
+        for volume in volumes.values()
+        if volume["Labels"] is not None and SCHEDULE_LABEL in volume["Labels"]
+    }
+    for job in scheduler.get_jobs():
+        if job.id.startswith("schedule:") and job.name not in schedules:
+            job.remove()
+            logger.info(f"Removed backup schedule {job.name}")
+    for schedule in schedules:
+        if scheduler.get_job(f"schedule:{schedule}") is not None:
+            continue
+        try:
+            trigger = create_trigger(schedule)
+        except ValueError:
+            if schedule not in invalid_schedules:
+                invalid_schedules.add(schedule)
+                logger.exception(
+                    f"Invalid {SCHEDULE_LABEL} label {schedule}, these volumes are not backed up"
+                )
+            continue
+        job = scheduler.add_job(
+            scheduled_backup,
+            trigger,
+            args=[[f"label={SCHEDULE_LABEL}={schedule}"]],
+            id=f"schedule:{schedule}",
+            name=schedule,
+        )
+        logger.info(
+            f"Backup of volumes with schedule {schedule} will run at {job.next_run_time}"
+        )
 
 
 async def control():
+    scheduler = AsyncIOScheduler()
+    scheduler.start()
     if config.backup_cron is not None:
-        scheduler = AsyncIOScheduler()
-        scheduler.start()
         backup_job = scheduler.add_job(
-            scheduled_backup, CronTrigger.from_crontab(config.backup_cron)
+            scheduled_backup,
+            create_trigger(config.backup_cron),
+            # Volumes with their own schedule are not part of the global backup
+            args=[[f"!label={SCHEDULE_LABEL}"]],
         )
         logger.info(f"Backup will run at {backup_job.next_run_time}")
 
     # NOTE: Has to be created inside the running event loop
     task_lock = asyncio.Lock()
 
+    install_metrics_handler()
+    install_history_handler()
+    # NOTE: Don't delay the start if the target is slow
+    load_metrics_task = asyncio.create_task(load_backup_metrics())
+
+    # Start containers which are still stopped after a crash or reboot
+    try:
+        async with aiodocker.Docker() as client:
+            # NOTE: Before the replay, a leftover runner could still stop containers
+            await remove_kept_runners(client)
+            await replay_journal_if_idle(client)
+    except Exception:
+        logger.exception("Failed to replay the restart journal")
+
+    # Keep the inventory up to date, so commands don't have to inspect every container again
+    watch_task = asyncio.create_task(
+        watch_inventory(partial(update_volume_schedules, scheduler))
+    )
+
     # NOTE: Don't use localhost, will be IPv6
     server = await asyncio.start_server(
         partial(handle_client, task_lock), "127.0.0.1", 6000
     )
+    metrics_server = None
+    if config.metrics_port is not None:
+        # NOTE: Has to be reachable from other containers, unlike the command server
+        metrics_server = await asyncio.start_server(
+            handle_metrics_request, "0.0.0.0", config.metrics_port
+        )
     try:
         async with server:
             logger.info("Waiting for commands")
             await server.serve_forever()
     finally:
         logging.info("Shutting down")
+        watch_task.cancel()
+        load_metrics_task.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
         await server.wait_closed()
+        # Don't keep volumes mounted after duplyvolume is stopped
+        async with aiodocker.Docker() as client:
+            await stop_kept_runners(client)
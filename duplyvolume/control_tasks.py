@@ -1,98 +1,219 @@
 import logging
 import os
 import re
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 import asyncio
 import aiodocker
+from aiodocker.execs import Exec
 from typing import Optional
 import json
 
-from .metadata import write_metadata, list_volumes_by_metadata, read_metadata
+from .metadata import (
+    write_metadata,
+    list_volumes_by_metadata,
+    read_metadata,
+    read_manifest,
+    write_manifest,
+)
 from .config import config
-from .docker_utils import find_myself, start_runner
-from .duplicity import find_last_backup
-from .utils import my_hostname, VolumeInfo
+from .docker_utils import RUNNER_LABEL, find_myself, job_start_times, start_runner
+from .inventory import Inventory, get_inventory
+from .history import finish_run, record_inventory, start_run
+from .journal import replay_journal
+from .metrics import record_metric
+from .duplicity import SNAPSHOT_DIRECTORY, find_last_backup
+from .utils import (
+    gather_limited,
+    has_label_selectors,
+    match_selectors,
+    my_hostname,
+    RestoreInfo,
+    VolumeInfo,
+)
 
 active_task: Optional[asyncio.Task] = None
+# Number of backups/restores waiting for the task lock
+queued_tasks = 0
+# Volumes without a backup in this window before the most recent backup are considered deleted and not restored
+RESTORE_WINDOW = timedelta(hours=6)
 logger = logging.getLogger(__name__)
 
 
-async def backup_stage1(task_lock: asyncio.Lock):
-    global active_task
-    async with task_lock, aiodocker.Docker() as client:
-        logger.info("Preparing backup")
-        volume_map: dict[str, VolumeInfo] = {}
-        stage2_mounts = []
-        myself = await find_myself(client)
-        for container_id in [
-            container.id for container in await client.containers.list(all=True)
-        ]:
-            # Skip own container
-            if container_id == myself.id:
+@asynccontextmanager
+async def queue_task(task_lock: asyncio.Lock, command: str):
+    global queued_tasks
+    queued_tasks += 1
+    record_metric("duplyvolume_queued_tasks", {}, queued_tasks)
+    try:
+        await task_lock.acquire()
+    finally:
+        queued_tasks -= 1
+        record_metric("duplyvolume_queued_tasks", {}, queued_tasks)
+    # NOTE: Only one run holds the lock, so the timings of the runner belong to it
+    start_run(command)
+    try:
+        yield
+    except:
+        finish_run("failure")
+        raise
+    else:
+        finish_run("success")
+    finally:
+        task_lock.release()
+
+
+def log_inventory(inventory: Inventory):
+    record_inventory(inventory.duration)
+    logger.info(
+        f"Inspected {len(inventory.containers)} containers and {len(inventory.volumes)} volumes in {inventory.duration:.2f}s"
+    )
+
+
+def warn_unmatched_selectors(
+    selectors: list[str], volume_labels: dict[str, Optional[dict[str, str]]]
+):
+    for selector in selectors:
+        # NOTE: Excluding selectors are expected to match nothing
+        if not selector.startswith("!") and not any(
+            match_selectors(volume_name, labels, [selector])
+            for volume_name, labels in volume_labels.items()
+        ):
+            logger.warning(f"No volume matches {selector}")
+
+
+def find_backup_volumes(
+    inventory: Inventory, selectors: list[str]
+) -> dict[str, VolumeInfo]:
+    volume_map: dict[str, VolumeInfo] = {}
+    myself = find_myself(inventory.containers.values())
+    for container in inventory.containers.values():
+        # Skip own container and a kept runner, it has the volumes of the last backup/restore
+        if container.id == myself.id or RUNNER_LABEL in (
+            container["Config"]["Labels"] or {}
+        ):
+            continue
+
+        for mount in container["Mounts"]:
+            if mount["Type"] == "volume" and mount["Name"] not in inventory.volumes:
+                # NOTE: get_inventory inspects missing volumes, so it was removed in the meantime
+                logger.warning(
+                    f"Volume {mount['Name']} of container {container['Name'].lstrip('/')} does not exist anymore, skipping it"
+                )
+                continue
+            if (
+                not mount["RW"]
+                or not mount["Type"] == "volume"
+                or (
+                    config.ignore_regex is not None
+                    and re.match(config.ignore_regex, mount["Name"])
+                )
+                or not match_selectors(
+                    mount["Name"],
+                    inventory.volumes[mount["Name"]]["Labels"],
+                    selectors,
+                )
+            ):
                 continue
+            volume_name = mount["Name"]
+            if volume_name not in volume_map:
+                volume_labels = inventory.volumes[volume_name]["Labels"]
+                if volume_labels is None:
+                    volume_labels = {}
 
-            # NOTE: containers.list does not return the full config
-            # NOTE: Don't continue here on error like in healthcheck. Restore/Backup assumes a stable environment without changes.
-            container = await client.containers.get(container_id)
-            for mount in container["Mounts"]:
-                if (
-                    not mount["RW"]
-                    or not mount["Type"] == "volume"
-                    or (
-                        config.ignore_regex is not None
-                        and re.match(config.ignore_regex, mount["Name"])
+                volume_info: VolumeInfo = {"used_by_containers": [container.id]}
+                if "duplyvolume.remove_older_than" in volume_labels:
+                    volume_info["remove_older_than"] = volume_labels[
+                        "duplyvolume.remove_older_than"
+                    ]
+                if "duplyvolume.remove_all_but_n_full" in volume_labels:
+                    volume_info["remove_all_but_n_full"] = int(
+                        volume_labels["duplyvolume.remove_all_but_n_full"]
                     )
-                ):
-                    continue
-                volume_name = mount["Name"]
-                if volume_name not in volume_map:
-                    volume_labels = (
-                        await (await client.volumes.get(volume_name)).show()
-                    )["Labels"]
-                    if volume_labels is None:
-                        volume_labels = {}
-
-                    volume_info: VolumeInfo = {"used_by_containers": [container.id]}
-                    if "duplyvolume.remove_older_than" in volume_labels:
-                        volume_info["remove_older_than"] = volume_labels[
-                            "duplyvolume.remove_older_than"
-                        ]
-                    if "duplyvolume.remove_all_but_n_full" in volume_labels:
-                        volume_info["remove_all_but_n_full"] = int(
-                            volume_labels["duplyvolume.remove_all_but_n_full"]
-                        )
-                    if "duplyvolume.remove_all_inc_of_but_n_full" in volume_labels:
-                        volume_info["remove_all_inc_of_but_n_full"] = int(
-                            volume_labels["duplyvolume.remove_all_inc_of_but_n_full"]
-                        )
-
-                    volume_map[volume_name] = volume_info
-
-                    stage2_mounts.append(
-                        {
-                            # NOTE: While creating a container it is "Target", otherwise "Destination"
-                            "Target": f"/source/{volume_name}",
-                            "Source": volume_name,
-                            "Type": "volume",
-                            "ReadOnly": True,
-                        }
+                if "duplyvolume.remove_all_inc_of_but_n_full" in volume_labels:
+                    volume_info["remove_all_inc_of_but_n_full"] = int(
+                        volume_labels["duplyvolume.remove_all_inc_of_but_n_full"]
                     )
-                else:
-                    volume_map[volume_name]["used_by_containers"].append(container.id)
+                if volume_labels.get("duplyvolume.snapshot") == "true":
+                    volume_info["snapshot"] = True
+
+                volume_map[volume_name] = volume_info
+            else:
+                volume_map[volume_name]["used_by_containers"].append(container.id)
+    return volume_map
 
+
+async def backup_stage1(task_lock: asyncio.Lock, selectors: list[str]):
+    global active_task
+    async with queue_task(task_lock, "backup"), aiodocker.Docker() as client:
+        logger.info("Preparing backup")
+        # NOTE: Don't skip removed containers like in healthcheck. Restore/Backup assumes a stable environment without changes.
+        inventory = await get_inventory(client)
+        log_inventory(inventory)
+        volume_map = find_backup_volumes(inventory, selectors)
+        stage2_mounts = [
+            {
+                # NOTE: While creating a container it is "Target", otherwise "Destination"
+                "Target": f"/source/{volume_name}",
+                "Source": volume_name,
+                "Type": "volume",
+                "ReadOnly": True,
+            }
+            for volume_name in volume_map.keys()
+        ]
+        snapshot_volume_names = [
+            volume_name
+            for volume_name, volume_info in volume_map.items()
+            if volume_info.get("snapshot", False)
+        ]
+        if config.snapshot_volume is not None and len(snapshot_volume_names) > 0:
+            stage2_mounts.append(
+                {
+                    "Target": SNAPSHOT_DIRECTORY,
+                    "Source": config.snapshot_volume,
+                    "Type": "volume",
+                    "ReadOnly": False,
+                }
+            )
+        elif len(snapshot_volume_names) > 0:
+            logger.warning(
+                f"SNAPSHOT_VOLUME is not set, snapshots of {", ".join(snapshot_volume_names)} are copied into the runner container"
+            )
+        myself = find_myself(inventory.containers.values())
+
+        warn_unmatched_selectors(
+            selectors,
+            {
+                volume_name: inventory.volumes[volume_name]["Labels"]
+                for volume_name in volume_map.keys()
+            },
+        )
         if len(stage2_mounts) == 0:
             logger.warning("Nothing found to back up, doing nothing")
             return
 
         logger.info("Updating volume metadata")
-        for volume_name in volume_map.keys():
-            volume = await client.volumes.get(volume_name)
-            volume_info = await volume.show()
-            await write_metadata(
-                volume_name,
-                # Only store Name/Labels for now, anything else is probably unnecessary and could cause issues
-                json.dumps(
-                    {k: v for k, v in volume_info.items() if k in {"Name", "Labels"}}
+        # Only store Name/Labels for now, anything else is probably unnecessary and could cause issues
+        volume_metadata = {
+            volume_name: {
+                k: v
+                for k, v in inventory.volumes[volume_name].items()
+                if k in {"Name", "Labels"}
+            }
+            for volume_name in volume_map.keys()
+        }
+        if config.metadata_manifest:
+            manifest = await read_manifest()
+            for volume_name, metadata in volume_metadata.items():
+                manifest["volumes"].setdefault(volume_name, {})["metadata"] = metadata
+            await write_manifest(manifest)
+        else:
+            await gather_limited(
+                config.api_concurrency,
+                (
+                    write_metadata(volume_name, json.dumps(metadata))
+                    for volume_name, metadata in volume_metadata.items()
                 ),
             )
 
@@ -110,26 +231,133 @@ async def backup_stage1(task_lock: asyncio.Lock):
             await active_task
         finally:
             active_task = None
+            # If the runner crashed, its containers would stay stopped until the next healthcheck
+            await replay_journal(client)
 
 
-async def restore_stage1(task_lock: asyncio.Lock):
+async def restore_stage1(task_lock: asyncio.Lock, selectors: list[str]):
     global active_task
-    async with task_lock, aiodocker.Docker() as client:
+    async with queue_task(task_lock, "restore"), aiodocker.Docker() as client:
         logger.info("Preparing restore")
-        volume_info = []
-        for volume_name in await list_volumes_by_metadata():
-            volume_info.append((volume_name, await find_last_backup(volume_name)))
-        if len(volume_info) == 0:
+        # NOTE: Don't skip removed containers like in healthcheck. Restore/Backup assumes a stable environment without changes.
+        inventory = await get_inventory(client)
+        log_inventory(inventory)
+        # Start probing as soon as the first volumes are listed, but limit the number of duplicity processes
+        probe_semaphore = asyncio.Semaphore(config.probe_concurrency)
+        probe_errors: dict[str, Exception] = {}
+
+        async def probe(volume_name: str) -> Optional[datetime]:
+            async with probe_semaphore:
+                start_time = time.monotonic()
+                try:
+                    date = await find_last_backup(volume_name)
+                except Exception as e:
+                    # Collect errors, so all failing volumes are reported at once
+                    logger.error(
+                        f"Failed to find last backup of volume {volume_name} after {time.monotonic() - start_time:.2f}s"
+                    )
+                    probe_errors[volume_name] = e
+                    return None
+                logger.info(
+                    f"Found last backup of volume {volume_name} from {date} in {time.monotonic() - start_time:.2f}s"
+                )
+                return date
+
+        manifest = await read_manifest()
+        # Stage 2 records every successful backup, so duplicity is only asked if a volume is missing
+        recorded_backups = {
+            volume_name: datetime.fromisoformat(volume["last_backup"])
+            for volume_name, volume in manifest["volumes"].items()
+            if "last_backup" in volume
+        }
+        # If there was no backup with METADATA_MANIFEST yet, use the metadata files of older backups
+        # NOTE: Volumes without metadata in the manifest always fall back to their metadata file
+        metadata_manifest = (
+            manifest
+            if config.metadata_manifest
+            and any("metadata" in volume for volume in manifest["volumes"].values())
+            else None
+        )
+
+        # Labels of the volumes in the target, only loaded if they are needed for a selector
+        volume_labels: dict[str, Optional[dict[str, str]]] = {}
+        stored_metadata: dict[str, dict] = {}
+
+        async def read_labels(volume_name: str) -> Optional[dict[str, str]]:
+            if volume_name in inventory.volumes:
+                return inventory.volumes[volume_name]["Labels"]
+            stored_metadata[volume_name] = json.loads(
+                await read_metadata(volume_name, metadata_manifest)
+            )
+            return stored_metadata[volume_name]["Labels"]
+
+        async def is_selected(volume_name: str) -> bool:
+            if has_label_selectors(selectors):
+                volume_labels[volume_name] = await read_labels(volume_name)
+            return match_selectors(
+                volume_name, volume_labels.get(volume_name), selectors
+            )
+
+        last_backups: dict[str, datetime] = {}
+        probes: dict[str, asyncio.Task[Optional[datetime]]] = {}
+        probed_volume_names: set[str] = set()
+        async with asyncio.TaskGroup() as task_group:
+            async for volume_name in list_volumes_by_metadata(metadata_manifest):
+                if not await is_selected(volume_name):
+                    continue
+                if volume_name in recorded_backups:
+                    last_backups[volume_name] = recorded_backups[volume_name]
+                else:
+                    probes[volume_name] = task_group.create_task(probe(volume_name))
+        while True:
+            if len(probe_errors) > 0:
+                raise Exception(
+                    f"Failed to find last backup of volumes {', '.join(probe_errors.keys())}"
+                ) from next(iter(probe_errors.values()))
+            for volume_name, task in probes.items():
+                date = task.result()
+                if date is not None:
+                    last_backups[volume_name] = date
+            probed_volume_names.update(probes.keys())
+            if len(last_backups) == 0:
+                break
+            # A recorded backup might be outdated (e.g. if a backup was made by an older version)
+            # Verify it with duplicity before the volume is excluded from the restore
+            window_start = max(last_backups.values()) - RESTORE_WINDOW
+            stale_volume_names = [
+                volume_name
+                for volume_name, date in last_backups.items()
+                if date < window_start and volume_name not in probed_volume_names
+                # Volumes selected by their name are always restored, so no backup has to be verified
+                and volume_name not in selectors
+            ]
+            if len(stale_volume_names) == 0:
+                break
+            async with asyncio.TaskGroup() as task_group:
+                probes = {
+                    volume_name: task_group.create_task(probe(volume_name))
+                    for volume_name in stale_volume_names
+                }
+
+        warn_unmatched_selectors(
+            selectors,
+            {
+                volume_name: volume_labels.get(volume_name)
+                for volume_name in last_backups.keys()
+            },
+        )
+        if len(last_backups) == 0:
             logger.warning("No volumes found in target, doing nothing")
             return
-        last_backup = max(date for _, date in volume_info)
-        volume_map: dict[str, list[str]] = {
-            volume_name: []
-            for volume_name, date in volume_info
-            if date >= last_backup - timedelta(hours=6)
+        last_backup = max(last_backups.values())
+        # NOTE: Only a selector with the exact name restores a volume without recent backups, globs, labels and excludes could match long deleted volumes
+        volume_map: dict[str, RestoreInfo] = {
+            volume_name: {"used_by_containers": []}
+            for volume_name, date in last_backups.items()
+            if volume_name in selectors or date >= last_backup - RESTORE_WINDOW
         }
         logger.info(
-            f"Restoring volumes {", ".join(volume_map.keys())} ({len(volume_map.keys())}/{len(volume_info)})",
+            f"Restoring volumes {", ".join(volume_map.keys())} ({len(volume_map.keys())}/{len(last_backups)})",
         )
         stage2_mounts = [
             {
@@ -141,39 +369,59 @@ async def restore_stage1(task_lock: asyncio.Lock):
             }
             for volume_name in volume_map.keys()
         ]
-        myself = await find_myself(client)
-        for container_id in [
-            container.id for container in await client.containers.list(all=True)
-        ]:
-            # Skip own container
-            if container_id == myself.id:
+        myself = find_myself(inventory.containers.values())
+        for container in inventory.containers.values():
+            # Skip own container and a kept runner
+            if container.id == myself.id or RUNNER_LABEL in (
+                container["Config"]["Labels"] or {}
+            ):
                 continue
 
-            # NOTE: containers.list does not return the full config
-            # NOTE: Don't continue here on error like in healthcheck. Restore/Backup assumes a stable environment without changes.
-            container = await client.containers.get(container_id)
             for mount in container["Mounts"]:
                 if not mount["Type"] == "volume":
                     continue
                 volume_name = mount["Name"]
                 if volume_name in volume_map:
-                    volume_map[volume_name].append(container.id)
+                    volume_map[volume_name]["used_by_containers"].append(container.id)
 
         if len(stage2_mounts) == 0:
             logger.warning("Nothing found to restore, doing nothing")
             return
 
         logger.info("Creating volumes with correct metadata if necessary")
-        existing_volume_names = [
-            volume["Name"] for volume in (await client.volumes.list())["Volumes"]
-        ]
-        for volume_name in volume_map.keys():
-            # If volume already exists, skip it
-            if volume_name in existing_volume_names:
-                continue
-            # Otherwise create it. This is only necessary to ensure it has the correct Labels (otherwise docker-compose complains)
-            volume_info = json.loads(await read_metadata(volume_name))
+
+        async def create_volume(volume_name: str) -> dict:
+            # This is only necessary to ensure it has the correct Labels (otherwise docker-compose complains)
+            if volume_name in stored_metadata:
+                volume_info = stored_metadata[volume_name]
+            else:
+                volume_info = json.loads(
+                    await read_metadata(volume_name, metadata_manifest)
+                )
             await client.volumes.create(volume_info)
+            return volume_info
+
+        created_volumes = await gather_limited(
+            config.api_concurrency,
+            (
+                create_volume(volume_name)
+                for volume_name in volume_map.keys()
+                # If volume already exists, skip it
+                if volume_name not in inventory.volumes
+            ),
+        )
+
+        existing_volumes = [
+            inventory.volumes[volume_name]
+            for volume_name in volume_map.keys()
+            if volume_name in inventory.volumes
+        ]
+        for volume_info in [*existing_volumes, *created_volumes]:
+            labels = volume_info["Labels"] or {}
+            if "duplyvolume.restore_priority" in labels:
+                volume_map[volume_info["Name"]]["restore_priority"] = int(
+                    labels["duplyvolume.restore_priority"]
+                )
 
         logger.info("Starting restore stage 2")
         active_task = asyncio.create_task(
@@ -189,24 +437,69 @@ async def restore_stage1(task_lock: asyncio.Lock):
             await active_task
         finally:
             active_task = None
+            # If the runner crashed, its containers would stay stopped until the next healthcheck
+            await replay_journal(client)
+
+
+async def replay_journal_if_idle(client: aiodocker.Docker):
+    # NOTE: Our own runner must not be active (the caller holds the task lock or control is starting)
+    # A runner of an earlier control container (e.g. recreated during a backup) is not covered by the task lock
+    leftover_runners = await client.containers.list(
+        filters=json.dumps({"label": [f"{RUNNER_LABEL}=once"]})
+    )
+    if len(leftover_runners) > 0:
+        # Its containers are started by the runner itself or by a later healthcheck
+        logger.warning(
+            "A runner of an earlier duplyvolume container is still running, not replaying the restart journal yet"
+        )
+        return
+    await replay_journal(client)
+
+
+async def check_kept_runner(
+    client: aiodocker.Docker, task_lock: asyncio.Lock, container_id: str
+):
+    # NOTE: The inventory is not updated for execs, so inspect it again
+    try:
+        runner_container = await client.containers.get(container_id)
+    except aiodocker.DockerError as e:
+        if e.status == 404:
+            return
+        raise
+    for exec_id in runner_container["ExecIDs"] or []:
+        try:
+            job = await Exec(client, exec_id).inspect()
+        except aiodocker.DockerError as e:
+            if e.status == 404:
+                continue
+            raise
+        if not job["Running"] or job["ProcessConfig"]["arguments"][:1] != [
+            "backup-stage2"
+        ]:
+            continue
+        if not task_lock.locked():
+            raise Exception(
+                "It seems like there is a leftover backup in a runner container. I won't stop it."
+            )
+        # Jobs of an earlier control container are as old as their runner at least
+        job_start = job_start_times.get(
+            exec_id, datetime.fromisoformat(runner_container["Created"][0:26])
+        )
+        if datetime.now() - job_start > timedelta(hours=3):
+            raise Exception("It seems like a backup is stuck.")
 
 
 async def healthcheck(task_lock: asyncio.Lock):
     async with aiodocker.Docker() as client:
-        for container_id in [
-            container.id for container in await client.containers.list(all=True)
-        ]:
-            try:
-                # NOTE: containers.list does not return the full config
-                container = await client.containers.get(container_id)
-            except aiodocker.DockerError as e:
-                if e.status == 404:
-                    # The container was removed since the call to .list()
-                    # Continue like it was never there, ignore the exception to avoid scary errors in log
-                    continue
-                raise
+        # NOTE: Acquiring an unlocked lock does not yield, so no runner can start in between
+        if not task_lock.locked():
+            async with task_lock:
+                await replay_journal_if_idle(client)
+        # Continue like removed containers were never there to avoid scary errors in log
+        inventory = await get_inventory(client, skip_removed=True)
+        for container in inventory.containers.values():
             container_entrypoint = container["Config"]["Entrypoint"]
-            container_cmd = container["Config"]["Cmd"]
+            container_cmd = container["Config"]["Cmd"] or []
             container_hostname = container["Config"]["Hostname"]
             container_creation = datetime.fromisoformat(container["Created"][0:26])
             # Has to match entrypoint
@@ -219,14 +512,22 @@ async def healthcheck(task_lock: asyncio.Lock):
                     raise Exception(
                         "It seems like there is another duplyvolume container running. Don't do that."
                     )
-                if container_cmd == ["backup-stage2"] and not task_lock.locked():
+                # NOTE: The volume map is the second argument of a runner
+                if (
+                    container_cmd[:1] == ["backup-stage2"]
+                    and container["State"]["Running"]
+                    and not task_lock.locked()
+                ):
                     raise Exception(
                         "It seems like there is a leftover backup container. I won't delete it."
                     )
-                if container_cmd == [
+                if container_cmd[:1] == [
                     "backup-stage2"
                 ] and datetime.now() - container_creation > timedelta(hours=3):
                     raise Exception("It seems like a backup is stuck.")
+                if container_cmd == ["runner-pool"]:
+                    # With RUNNER_KEEP_ALIVE, backups run as execs in the kept runner
+                    await check_kept_runner(client, task_lock, container.id)
 
 
 async def cancel_backup(task_lock: asyncio.Lock):
@@ -1,56 +1,268 @@
 import json
 import logging
 import os
-from typing import Optional
+import time
+from datetime import datetime
+from typing import Iterable, Optional
 import asyncio
 import aiodocker
 from aiodocker.containers import DockerContainer
 
+from .config import config
+from .history import apply_history_message
+from .journal import apply_journal_message, record_start, record_stop
+from .metrics import apply_metric_message, record_metric
 from .utils import my_hostname
 
 logger = logging.getLogger(__name__)
 restart_queue: list[str] = []
+# Containers which still need to run their duplyvolume.post_exec hook
+post_exec_queue: list[str] = []
+# Container id -> time.monotonic() when it was stopped, for the downtime metrics
+stop_times: dict[str, float] = {}
+# Set on runner containers, "pool" for runners which are kept between backups/restores (RUNNER_KEEP_ALIVE)
+RUNNER_LABEL = "duplyvolume.runner"
+# Mounts (see mounts_key) -> id of the runner which is kept for them, so backups with different volumes (e.g. schedules) have their own runner
+# NOTE: Only the id is kept, every backup/restore has its own Docker client
+kept_runners: dict[str, str] = {}
+# Mounts (see mounts_key) -> task which stops the kept runner if it is not used again in time
+expiry_tasks: dict[str, asyncio.Task] = {}
+# Exec id -> start of a job in a kept runner, for the healthcheck
+job_start_times: dict[str, datetime] = {}
 
 
-async def stop_containers(client: aiodocker.Docker, containers: list[str]):
-    for container_id in containers:
-        target_container = await client.containers.get(container_id)
-        if target_container["State"]["Status"] == "running":
-            logger.info(f"Stopping container {target_container["Name"].lstrip("/")}")
-            try:
-                await target_container.stop()
-                restart_queue.append(container_id)
-            except asyncio.CancelledError:
-                # NOTE: This is important if our own process terminates during stop (wait for stop or start won't work)
-                await target_container.stop()
-                # NOTE: It is important that this also happens in the cancel case
-                restart_queue.append(container_id)
+async def run_hook(container: DockerContainer, hook: str, command: str):
+    container_name = container["Name"].lstrip("/")
+    logger.info(f"Running {hook} in container {container_name}")
+    start_time = time.monotonic()
+    execution = await container.exec(["sh", "-c", command], stdout=True, stderr=True)
+    async with execution.start(detach=False) as stream:
+        while (message := await stream.read_out()) is not None:
+            for line in message.data.decode("utf-8", "replace").splitlines():
+                logger.info(f"{container_name}: {line}")
+    exit_code = (await execution.inspect())["ExitCode"]
+    # NOTE: Also for failed hooks, a slow failing pre_exec keeps the container stopped as well
+    duration = time.monotonic() - start_time
+    record_metric(
+        "duplyvolume_hook_duration_seconds",
+        {"container": container_name, "hook": hook},
+        duration,
+    )
+    if exit_code != 0:
+        raise Exception(
+            f"{hook} failed in container {container_name} with code {exit_code}"
+        )
+    logger.info(f"Finished {hook} in container {container_name} in {duration:.2f}s")
+
+
+def dependency_levels(
+    containers: list[DockerContainer],
+) -> list[list[DockerContainer]]:
+    # Groups containers in the order they have to be started, every container only depends on containers of earlier levels
+    # NOTE: Only dependencies within the same compose project are known (from depends_on)
+    services: dict[tuple[Optional[str], str], list[str]] = {}
+    for container in containers:
+        labels = container["Config"]["Labels"] or {}
+        if "com.docker.compose.service" in labels:
+            services.setdefault(
+                (
+                    labels.get("com.docker.compose.project"),
+                    labels["com.docker.compose.service"],
+                ),
+                [],
+            ).append(container.id)
+
+    dependencies: dict[str, set[str]] = {}
+    for container in containers:
+        labels = container["Config"]["Labels"] or {}
+        # NOTE: The format is "<service>:<condition>:<restart>,..."
+        dependencies[container.id] = {
+            dependency_id
+            for dependency in labels.get("com.docker.compose.depends_on", "").split(",")
+            if dependency != ""
+            for dependency_id in services.get(
+                (
+                    labels.get("com.docker.compose.project"),
+                    dependency.split(":")[0],
+                ),
+                [],
+            )
+        }
+
+    levels: list[list[DockerContainer]] = []
+    remaining = {container.id: container for container in containers}
+    while len(remaining) > 0:
+        level = [
+            container
+            for container_id, container in remaining.items()
+            if len(dependencies[container_id] & remaining.keys()) == 0
+        ]
+        if len(level) == 0:
+            # Cyclic dependencies, handle the rest at once
+            level = list(remaining.values())
+        for container in level:
+            del remaining[container.id]
+        levels.append(level)
+    return levels
+
+
+def record_downtime(container_name: str, downtime: float):
+    labels = {"container": container_name}
+    record_metric("duplyvolume_container_downtime_seconds", labels, downtime, add=True)
+    record_metric("duplyvolume_last_container_downtime_seconds", labels, downtime)
+
+
+async def stop_container(target_container: DockerContainer, run_hooks: bool):
+    container_id = target_container.id
+    if target_container["State"]["Status"] == "running":
+        if run_hooks:
+            labels = target_container["Config"]["Labels"] or {}
+            if "duplyvolume.post_exec" in labels:
+                # NOTE: Queue it before pre_exec, so it also runs if pre_exec fails halfway
+                post_exec_queue.append(container_id)
+            if "duplyvolume.pre_exec" in labels:
+                await run_hook(
+                    target_container, "pre_exec", labels["duplyvolume.pre_exec"]
+                )
+            if labels.get("duplyvolume.stop") == "false":
+                return
+        logger.info(f"Stopping container {target_container["Name"].lstrip("/")}")
+        record_stop(container_id, target_container["Name"].lstrip("/"))
+        stop_times[container_id] = time.monotonic()
+        try:
+            await target_container.stop()
+            restart_queue.append(container_id)
+        except asyncio.CancelledError:
+            # NOTE: This is important if our own process terminates during stop (wait for stop or start won't work)
+            await target_container.stop()
+            # NOTE: It is important that this also happens in the cancel case
+            restart_queue.append(container_id)
+            raise
+
+
+async def stop_containers(
+    client: aiodocker.Docker, containers: list[str], run_hooks: bool = False
+):
+    async def get_container(container_id: str) -> Optional[DockerContainer]:
+        try:
+            return await client.containers.get(container_id)
+        except aiodocker.DockerError as e:
+            if e.status != 404:
                 raise
+            # The container was removed since the inventory was loaded, there is nothing to stop
+            logger.warning(f"Container {container_id} does not exist anymore")
+            return None
+
+    target_containers = [
+        target_container
+        for target_container in await asyncio.gather(
+            *(get_container(container_id) for container_id in containers)
+        )
+        if target_container is not None
+    ]
+    # Stop containers before the containers they depend on, all containers of a level at the same time
+    # NOTE: If one stop fails, the TaskGroup cancels the others and waits until they are in restart_queue
+    for level in reversed(dependency_levels(target_containers)):
+        async with asyncio.TaskGroup() as task_group:
+            for target_container in level:
+                task_group.create_task(stop_container(target_container, run_hooks))
+
+
+async def start_container(target_container: DockerContainer):
+    container_id = target_container.id
+    logger.info(f"Starting container {target_container["Name"].lstrip("/")}")
+    try:
+        await target_container.start()
+        restart_queue.remove(container_id)
+    except asyncio.CancelledError:
+        await target_container.start()
+        restart_queue.remove(container_id)
+        raise
+    finally:
+        if container_id not in restart_queue:
+            record_start(container_id)
+            if container_id in stop_times:
+                record_downtime(
+                    target_container["Name"].lstrip("/"),
+                    time.monotonic() - stop_times.pop(container_id),
+                )
 
 
 async def start_containers(
-    client: aiodocker.Docker, exclude_containers: Optional[list[str]] = None
+    client: aiodocker.Docker, containers: Optional[list[str]] = None
 ):
-    for container_id in list(restart_queue):
-        if container_id in ([] if exclude_containers is None else exclude_containers):
-            continue
-        target_container = await client.containers.get(container_id)
-        logger.info(f"Starting container {target_container["Name"].lstrip("/")}")
+    # Start the given containers (or all of them) if they were stopped by us
+    # NOTE: One failing container must not keep the others stopped, the errors are raised after all containers were started
+    errors: list[Exception] = []
+
+    async def get_container(container_id: str) -> Optional[DockerContainer]:
         try:
-            await target_container.start()
+            return await client.containers.get(container_id)
+        except aiodocker.DockerError as e:
+            if e.status != 404:
+                logger.error(f"Failed to inspect container {container_id}: {e}")
+                errors.append(e)
+                return None
+            # The container was removed during the backup/restore, there is nothing to start
+            logger.warning(f"Container {container_id} was removed, not starting it")
             restart_queue.remove(container_id)
-        except asyncio.CancelledError:
-            await target_container.start()
-            restart_queue.remove(container_id)
-            raise
+            stop_times.pop(container_id, None)
+            if container_id in post_exec_queue:
+                post_exec_queue.remove(container_id)
+            record_start(container_id)
+            return None
 
+    async def try_start_container(target_container: DockerContainer):
+        try:
+            await start_container(target_container)
+        except aiodocker.DockerError as e:
+            logger.error(
+                f"Failed to start container {target_container["Name"].lstrip("/")}: {e}"
+            )
+            errors.append(e)
+
+    target_containers = [
+        target_container
+        for target_container in await asyncio.gather(
+            *(
+                get_container(container_id)
+                for container_id in list(restart_queue)
+                if containers is None or container_id in containers
+            )
+        )
+        if target_container is not None
+    ]
+    # Start containers after the containers they depend on, all containers of a level at the same time
+    for level in dependency_levels(target_containers):
+        async with asyncio.TaskGroup() as task_group:
+            for target_container in level:
+                task_group.create_task(try_start_container(target_container))
+
+    # NOTE: Every hook runs, also if a container or an earlier hook failed
+    for container_id in list(post_exec_queue):
+        if containers is not None and container_id not in containers:
+            continue
+        # NOTE: Remove it first, a failing hook should not run again
+        post_exec_queue.remove(container_id)
+        try:
+            target_container = await client.containers.get(container_id)
+            await run_hook(
+                target_container,
+                "post_exec",
+                target_container["Config"]["Labels"]["duplyvolume.post_exec"],
+            )
+        except Exception as e:
+            logger.error(f"Failed to run post_exec of container {container_id}: {e}")
+            errors.append(e)
 
-async def find_myself(client: aiodocker.Docker) -> DockerContainer:
-    for container_id in [
-        container.id for container in await client.containers.list(all=True)
-    ]:
-        # NOTE: containers.list does not return the full config
-        container = await client.containers.get(container_id)
+    if len(errors) > 0:
+        raise Exception(
+            f"Failed to start {len(errors)} containers or run their post_exec"
+        ) from errors[0]
+
+
+def find_myself(containers: Iterable[DockerContainer]) -> DockerContainer:
+    for container in containers:
         if container["Config"]["Hostname"] == my_hostname:
             return container
     raise Exception("Unable to find current container, aborting backup")
@@ -75,6 +287,56 @@ def convert_mount(old_mount: dict) -> dict:
         raise Exception(f"Unknown mount type {old_mount['Type']}")
 
 
+def runner_config(
+    cmd: list[str], mounts: list[dict], myself: DockerContainer, labels: dict[str, str]
+) -> dict:
+    return {
+        "Cmd": cmd,
+        "Image": myself["Image"],
+        "Env": [f"{key}={value}" for key, value in os.environ.items()],
+        "Labels": labels,
+        # NOTE: The healthcheck of the image only works in the control container
+        "Healthcheck": {"Test": ["NONE"]},
+        "HostConfig": {
+            "AutoRemove": True,
+            # "Inherit" mounts (also important for secrets)
+            # NOTE: The format is incompatible to the one returned by get()
+            "Mounts": [
+                *[convert_mount(mount) for mount in myself["Mounts"]],
+                *mounts,
+            ],
+        },
+        "AttachStdin": False,
+        "AttachStdout": False,
+        "AttachStderr": False,
+        "Tty": False,
+        "OpenStdin": False,
+    }
+
+
+def handle_runner_line(line: str):
+    runner_logger = logging.getLogger(__package__).getChild("runner")
+    parts = line.rstrip("\n").split(":", 2)
+    if len(parts) == 3 and "." in parts[1]:
+        levelname, name, message = parts
+        _, name_suffix = name.split(".", 2)
+        if name_suffix == "journal":
+            apply_journal_message(message)
+            return
+        if name_suffix == "metrics":
+            apply_metric_message(message)
+            return
+        if name_suffix == "history":
+            apply_history_message(message)
+            return
+        # The name -> level conversion is legacy behavior
+        runner_logger.getChild(name_suffix).log(
+            logging.getLevelName(levelname), message
+        )
+    else:
+        runner_logger.error(":".join(parts))
+
+
 async def start_runner(
     mounts: list[dict],
     command: str,
@@ -82,26 +344,14 @@ async def start_runner(
     myself: DockerContainer,
     client: aiodocker.Docker,
 ):
+    if config.runner_keep_alive is not None:
+        await run_in_kept_runner(mounts, command, args, myself, client)
+        return
+
     runner_container = await client.containers.run(
-        {
-            "Cmd": [command, json.dumps(args)],
-            "Image": myself["Image"],
-            "Env": [f"{key}={value}" for key, value in os.environ.items()],
-            "HostConfig": {
-                "AutoRemove": True,
-                # "Inherit" mounts (also important for secrets)
-                # NOTE: The format is incompatible to the one returned by get()
-                "Mounts": [
-                    *[convert_mount(mount) for mount in myself["Mounts"]],
-                    *mounts,
-                ],
-            },
-            "AttachStdin": False,
-            "AttachStdout": False,
-            "AttachStderr": False,
-            "Tty": False,
-            "OpenStdin": False,
-        }
+        runner_config(
+            [command, json.dumps(args)], mounts, myself, {RUNNER_LABEL: "once"}
+        )
     )
 
     runner_status = None
@@ -113,18 +363,8 @@ async def start_runner(
     # If we wait after the log stream is closed, the container might have been already deleted
     wait_task = asyncio.create_task(do_wait())
     try:
-        runner_logger = logging.getLogger(__package__).getChild("runner")
         async for line in runner_container.log(stdout=True, stderr=True, follow=True):
-            parts = line.rstrip("\n").split(":", 2)
-            if len(parts) == 3 and "." in parts[1]:
-                levelname, name, message = parts
-                _, name_suffix = name.split(".", 2)
-                # The name -> level conversion is legacy behavior
-                runner_logger.getChild(name_suffix).log(
-                    logging.getLevelName(levelname), message
-                )
-            else:
-                runner_logger.error(":".join(parts))
+            handle_runner_line(line)
     except asyncio.CancelledError:
         await runner_container.stop()
         # NOTE: The wait_task might be cancelled, we have to wait here again
@@ -135,3 +375,115 @@ async def start_runner(
 
     if runner_status != 0:
         raise Exception(f"Runner failed with code {runner_status}")
+
+
+def mounts_key(mounts: list[dict]) -> str:
+    return json.dumps(mounts, sort_keys=True)
+
+
+async def get_kept_runner(
+    mounts: list[dict], myself: DockerContainer, client: aiodocker.Docker
+) -> DockerContainer:
+    # NOTE: Mounts cannot be changed, a runner can only be reused for the same volumes
+    key = mounts_key(mounts)
+    if key in kept_runners:
+        try:
+            runner_container = await client.containers.get(kept_runners[key])
+            if runner_container["State"]["Running"]:
+                logger.info("Reusing runner container")
+                return runner_container
+        except aiodocker.DockerError as e:
+            if e.status != 404:
+                raise
+        await stop_kept_runner(client, key)
+
+    runner_container = await client.containers.run(
+        runner_config(["runner-pool"], mounts, myself, {RUNNER_LABEL: "pool"})
+    )
+    kept_runners[key] = runner_container.id
+    return runner_container
+
+
+async def stop_kept_runner(client: aiodocker.Docker, key: str):
+    if key in expiry_tasks:
+        expiry_tasks.pop(key).cancel()
+    if key not in kept_runners:
+        return
+    runner_id = kept_runners.pop(key)
+    try:
+        # NOTE: The runner forwards the stop to running jobs (see keep_runner_alive)
+        runner_container = await client.containers.get(runner_id)
+        await runner_container.stop()
+        await runner_container.wait()
+    except aiodocker.DockerError as e:
+        # It is already removed (AutoRemove)
+        if e.status != 404:
+            raise
+
+
+async def stop_kept_runners(client: aiodocker.Docker):
+    for key in list(kept_runners.keys()):
+        await stop_kept_runner(client, key)
+
+
+async def expire_kept_runner(key: str):
+    # Make the type checker happy
+    assert config.runner_keep_alive is not None
+    await asyncio.sleep(config.runner_keep_alive)
+    # NOTE: Don't cancel this task while it stops the runner
+    del expiry_tasks[key]
+    async with aiodocker.Docker() as client:
+        await stop_kept_runner(client, key)
+    logger.info("Stopped unused runner container")
+
+
+async def remove_kept_runners(client: aiodocker.Docker):
+    # Kept runners of an earlier control container, they might still hold volumes
+    # NOTE: Not runners of a single backup/restore, they still start their containers again (see replay_journal_if_idle)
+    for runner_container in await client.containers.list(
+        all=True, filters=json.dumps({"label": [f"{RUNNER_LABEL}=pool"]})
+    ):
+        await runner_container.delete(force=True)
+        logger.warning(f"Removed leftover runner container {runner_container.id}")
+
+
+async def run_in_kept_runner(
+    mounts: list[dict],
+    command: str,
+    args: dict,
+    myself: DockerContainer,
+    client: aiodocker.Docker,
+):
+    key = mounts_key(mounts)
+    if key in expiry_tasks:
+        expiry_tasks.pop(key).cancel()
+    runner_container = await get_kept_runner(mounts, myself, client)
+    execution = await runner_container.exec(
+        ["duplyvolume", command, json.dumps(args)], stdout=True, stderr=True
+    )
+    try:
+        async with execution.start(detach=False) as stream:
+            job_start_times[execution.id] = datetime.now()
+            # Stream -> incomplete line, the output is not split at line breaks
+            buffers: dict[int, bytes] = {}
+            while (message := await stream.read_out()) is not None:
+                *lines, buffers[message.stream] = (
+                    buffers.get(message.stream, b"") + message.data
+                ).split(b"\n")
+                for line in lines:
+                    handle_runner_line(line.decode("utf-8", "replace"))
+            for buffer in buffers.values():
+                if len(buffer) > 0:
+                    handle_runner_line(buffer.decode("utf-8", "replace"))
+    except asyncio.CancelledError:
+        await stop_kept_runner(client, key)
+        raise
+    finally:
+        job_start_times.pop(execution.id, None)
+
+    exit_code = (await execution.inspect())["ExitCode"]
+    if exit_code != 0:
+        # Don't reuse a runner after an error, start with a clean one
+        await stop_kept_runner(client, key)
+        raise Exception(f"Runner failed with code {exit_code}")
+    expiry_tasks[key] = asyncio.create_task(expire_kept_runner(key))
@@ -1,14 +1,66 @@
 import logging
 import os
-import shutil
-from datetime import datetime
+import re
+import time
+from datetime import datetime, timedelta
 import asyncio
-from typing import Optional
+from typing import Optional, TypedDict
 
 from .config import config
+from .fs_utils import (
+    PROGRESS_INTERVAL,
+    move_directory_content,
+    sync_directory,
+    wipe_directory,
+)
+from .metrics import record_metric
+from .utils import format_size
 
 logger = logging.getLogger(__name__)
 
+# Used by RESTORE_MODE=swap/sync inside of the volume, so the data can be moved without copying
+STAGING_DIRECTORY = ".duplyvolume-restore"
+# Snapshots of volumes are taken here, SNAPSHOT_VOLUME is mounted at this path if it is set
+SNAPSHOT_DIRECTORY = "/snapshots"
+# Output of --progress, e.g. "1.2GB 00:01:07 [18.5MB/s] [=====>                 ] 15% ETA 6min"
+PROGRESS_REGEX = re.compile(
+    r"^([\d.]+)([KMGT]?B) (.+?) \[([\d.]+)([KMGT]?B)/s\] \[.*\] *(\d+)% ETA (.*)$"
+)
+SIZE_UNITS = {"B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3, "TB": 1024**4}
+# Units of time intervals like "1M" or "2W3D", see https://duplicity.gitlab.io/stable/duplicity.1.html#time-formats
+INTERVAL_UNITS = {
+    "s": 1,
+    "m": 60,
+    "h": 3600,
+    "D": 86400,
+    "W": 7 * 86400,
+    "M": 30 * 86400,
+    "Y": 365 * 86400,
+}
+
+
+class Progress(TypedDict):
+    processed_bytes: float
+    # As printed by duplicity, e.g. "00:01:07"
+    elapsed: str
+    bytes_per_second: float
+    percent: int
+    # As printed by duplicity, e.g. "6min" or "Stalled!"
+    eta: str
+
+
+def parse_progress(line: str) -> Optional[Progress]:
+    match = PROGRESS_REGEX.match(line)
+    if match is None:
+        return None
+    return {
+        "processed_bytes": float(match[1]) * SIZE_UNITS[match[2]],
+        "elapsed": match[3],
+        "bytes_per_second": float(match[4]) * SIZE_UNITS[match[5]],
+        "percent": int(match[6]),
+        "eta": match[7],
+    }
+
 
 async def find_last_backup(volume_name: str):
     # It seems like there is no machine-readable output option (jsonstat is something different)
@@ -34,8 +86,68 @@ async def find_last_backup(volume_name: str):
     )
 
 
-async def do_backup(volume_name: str):
-    await run_duplicity(
+def parse_time(value: str) -> Optional[datetime]:
+    # The point in time of a duplicity time (e.g. "1M" is one month ago), None if the format is not supported
+    if value == "now":
+        return datetime.now()
+    if re.fullmatch(r"(\d+[smhDWMY])+", value):
+        return datetime.now() - timedelta(
+            seconds=sum(
+                int(count) * INTERVAL_UNITS[unit]
+                for count, unit in re.findall(r"(\d+)([smhDWMY])", value)
+            )
+        )
+    try:
+        time = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    # NOTE: Dates from duplicity and datetime.now() are local times without a time zone
+    return time if time.tzinfo is None else time.astimezone().replace(tzinfo=None)
+
+
+def parse_last_full_backup(lines: list[str]) -> Optional[datetime]:
+    # The full backup an incremental backup is based on, None if duplicity made a full backup
+    if any(
+        "forcing full backup" in line or "switching to full backup" in line
+        for line in lines
+    ):
+        return None
+    for line in lines:
+        if line.startswith("Last full backup date: "):
+            try:
+                return datetime.strptime(
+                    line[len("Last full backup date: ") :], "%a %b %d %H:%M:%S %Y"
+                )
+            except ValueError:
+                # "none" if there is no full backup yet
+                return None
+    return None
+
+
+def parse_backup_statistics(lines: list[str]) -> dict[str, float]:
+    # Parses the block between "[ Backup Statistics ]" and the next "-----" line, e.g. "SourceFileSize 1234 (1.21 KB)"
+    statistics: dict[str, float] = {}
+    in_statistics = False
+    for line in lines:
+        if "[ Backup Statistics ]" in line:
+            in_statistics = True
+        elif line.startswith("-----"):
+            in_statistics = False
+        elif in_statistics:
+            parts = line.split(" ")
+            if len(parts) >= 2:
+                try:
+                    statistics[parts[0]] = float(parts[1])
+                except ValueError:
+                    pass
+    return statistics
+
+
+async def do_backup(
+    volume_name: str, source: Optional[str] = None
+) -> tuple[dict[str, float], Optional[datetime]]:
+    # Returns the statistics and the date of the last full backup (None if this was a full backup)
+    output = await run_duplicity(
         "duplicity",
         "backup",
         *(
@@ -43,11 +155,14 @@ async def do_backup(volume_name: str):
             if config.full_if_older_than is None
             else ["--full-if-older-than", config.full_if_older_than]
         ),
-        "--allow-source-mismatch",  # TODO: is this necessary?
+        # NOTE: Necessary for backups from snapshots, their path is different
+        "--allow-source-mismatch",
+        *(["--progress"] if config.progress else []),
         *config.duplicity_flags,
-        f"/source/{volume_name}",
+        f"/source/{volume_name}" if source is None else source,
         config.duplicity_target(volume_name),
     )
+    return parse_backup_statistics(output), parse_last_full_backup(output)
 
 
 async def do_remove(
@@ -78,24 +193,58 @@ async def do_remove(
 
 
 async def do_restore(volume_name: str):
-    # Delete content of volume because duplicity will never remove files (even with --force)
-    for filename in await asyncio.to_thread(os.listdir, f"/source/{volume_name}"):
-        file_path = f"/source/{volume_name}/{filename}"
-        if await asyncio.to_thread(os.path.isdir, file_path):
-            await asyncio.to_thread(shutil.rmtree, file_path)
+    volume_path = f"/source/{volume_name}"
+    if config.restore_mode in {"swap", "sync"}:
+        # Restore next to the old data and only replace it if the restore succeeded
+        staging_path = f"{volume_path}/{STAGING_DIRECTORY}"
+        if await asyncio.to_thread(os.path.exists, staging_path):
+            # Leftover of a failed restore
+            await wipe_directory(staging_path)
+            await asyncio.to_thread(os.rmdir, staging_path)
+        try:
+            await run_duplicity(
+                "duplicity",
+                "restore",
+                *(["--progress"] if config.progress else []),
+                *config.duplicity_flags,
+                config.duplicity_target(volume_name),
+                staging_path,
+            )
+        except:
+            if await asyncio.to_thread(os.path.exists, staging_path):
+                await wipe_directory(staging_path)
+                await asyncio.to_thread(os.rmdir, staging_path)
+            raise
+        if config.restore_mode == "sync":
+            statistics = await asyncio.to_thread(
+                sync_directory,
+                staging_path,
+                volume_path,
+                frozenset({STAGING_DIRECTORY}),
+            )
+            logger.info(
+                f"Replaced {statistics['replaced']}, removed {statistics['removed']} and kept {statistics['unchanged']} unchanged files and directories"
+            )
+            # Only unchanged entries are left
+            await wipe_directory(staging_path)
+            await asyncio.to_thread(os.rmdir, staging_path)
         else:
-            await asyncio.to_thread(os.unlink, file_path)
-
-    await run_duplicity(
-        "duplicity",
-        "restore",
-        *config.duplicity_flags,
-        config.duplicity_target(volume_name),
-        f"/source/{volume_name}",
-    )
+            await wipe_directory(volume_path, exclude=frozenset({STAGING_DIRECTORY}))
+            await asyncio.to_thread(move_directory_content, staging_path, volume_path)
+    else:
+        # Delete content of volume because duplicity will never remove files (even with --force)
+        await wipe_directory(volume_path)
+        await run_duplicity(
+            "duplicity",
+            "restore",
+            *(["--progress"] if config.progress else []),
+            *config.duplicity_flags,
+            config.duplicity_target(volume_name),
+            volume_path,
+        )
 
 
-async def run_duplicity(*args: str):
+async def run_duplicity(*args: str) -> list[str]:
     duplicity_process = await asyncio.create_subprocess_exec(
         args[0],
         *args[1:],
@@ -106,18 +255,59 @@ async def run_duplicity(*args: str):
     # Make the type checker happy
     assert duplicity_process.stdout is not None
     assert duplicity_process.stderr is not None
+    output: list[str] = []
+    last_progress_time: Optional[float] = None
     try:
 
         async def forward(reader: asyncio.StreamReader, func):
+            buffer = b""
             while True:
-                line = await reader.readline()
-                if len(line) == 0:
+                chunk = await reader.read(64 * 1024)
+                if len(chunk) == 0:
                     break
-                func(line.decode("utf-8").strip())
+                buffer += chunk
+                # NOTE: Progress updates might end with "\r" instead of a new line
+                # A "\r" at the end might be the first half of a "\r\n" in the next chunk, so keep it until then
+                pending_cr = buffer.endswith(b"\r")
+                *lines, buffer = re.split(
+                    rb"\r\n|\r|\n", buffer[:-1] if pending_cr else buffer
+                )
+                if pending_cr:
+                    buffer += b"\r"
+                for line in lines:
+                    func(line.decode("utf-8").strip())
+            if len(buffer) > 0:
+                func(buffer.decode("utf-8").strip())
+
+        def log_progress(line: str) -> bool:
+            nonlocal last_progress_time
+            progress = parse_progress(line)
+            if progress is None:
+                return False
+            # Duplicity updates the progress every few seconds, only log some of them
+            if (
+                last_progress_time is None
+                or time.monotonic() - last_progress_time >= PROGRESS_INTERVAL
+                or progress["percent"] == 100
+            ):
+                last_progress_time = time.monotonic()
+                logger.info(
+                    f"Progress {progress['percent']}%, {format_size(progress['processed_bytes'])} processed at {format_size(progress['bytes_per_second'])}/s, ETA {progress['eta']}"
+                )
+            return True
+
+        def log_output(line: str):
+            if not log_progress(line):
+                output.append(line)
+                logger.info(line)
+
+        def log_error(line: str):
+            if not log_progress(line):
+                logger.error(line)
 
         await asyncio.gather(
-            forward(duplicity_process.stdout, logger.info),
-            forward(duplicity_process.stderr, logger.error),
+            forward(duplicity_process.stdout, log_output),
+            forward(duplicity_process.stderr, log_error),
         )
     except:
         try:
@@ -128,7 +318,14 @@ async def run_duplicity(*args: str):
             pass
     finally:
         duplicity_status = await duplicity_process.wait()
+        record_metric(
+            "duplyvolume_duplicity_exits",
+            {"command": args[1], "code": str(duplicity_status)},
+            1,
+            add=True,
+        )
 
     # NOTE: It is important that we raise the CancelledError and nothing else if a coroutine is cancelled
     if duplicity_status:
         raise Exception(f"Duplicity failed with code {duplicity_status}")
+    return output
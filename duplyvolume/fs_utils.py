@@ -0,0 +1,288 @@
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import batched
+from typing import Optional
+import asyncio
+
+logger = logging.getLogger(__name__)
+
+# Deleting is limited by filesystem latency and not by CPU, so use more threads than cores
+WIPE_THREADS = 16
+# Log the progress of long running operations in this interval (seconds)
+PROGRESS_INTERVAL = 10
+# ioctl of btrfs/xfs to share the data blocks of two files, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def remove_files(path: str, exclude: frozenset[str]) -> tuple[list[str], int]:
+    # Remove everything except directories, return the directories and the number of removed entries
+    directories = []
+    removed = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name in exclude:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            else:
+                os.unlink(entry.path)
+                removed += 1
+    return directories, removed
+
+
+async def wipe_directory(path: str, exclude: frozenset[str] = frozenset()):
+    # Removes the content of path (but not path itself), except for the top level entries in exclude
+    loop = asyncio.get_running_loop()
+    removed = 0
+    start_time = time.monotonic()
+
+    async def report_progress():
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            logger.info(
+                f"Removed {removed} files and directories from {path} in {time.monotonic() - start_time:.0f}s"
+            )
+
+    progress_task = asyncio.create_task(report_progress())
+    try:
+        with ThreadPoolExecutor(WIPE_THREADS) as executor:
+            directories, removed = await loop.run_in_executor(
+                executor, remove_files, path, exclude
+            )
+            # Directories by depth, every level is handled in batches of the thread pool size
+            # NOTE: This keeps the number of pending tasks bounded, even for trees with millions of directories
+            levels = [directories]
+            while len(levels[-1]) > 0:
+                next_level: list[str] = []
+                for batch in batched(levels[-1], WIPE_THREADS):
+                    for subdirectories, removed_files in await asyncio.gather(
+                        *(
+                            loop.run_in_executor(
+                                executor, remove_files, directory, frozenset()
+                            )
+                            for directory in batch
+                        )
+                    ):
+                        removed += removed_files
+                        next_level.extend(subdirectories)
+                levels.append(next_level)
+            # The directories are empty now, remove the deepest ones first
+            for level in reversed(levels):
+                for batch in batched(level, WIPE_THREADS):
+                    await asyncio.gather(
+                        *(
+                            loop.run_in_executor(executor, os.rmdir, directory)
+                            for directory in batch
+                        )
+                    )
+                    removed += len(batch)
+    finally:
+        progress_task.cancel()
+
+    logger.debug(
+        f"Removed {removed} files and directories from {path} in {time.monotonic() - start_time:.2f}s"
+    )
+
+
+def move_directory_content(source: str, destination: str):
+    # NOTE: Renaming is cheap as long as both paths are on the same filesystem
+    with os.scandir(source) as entries:
+        for entry in entries:
+            os.rename(entry.path, os.path.join(destination, entry.name))
+    os.rmdir(source)
+
+
+def tree_fingerprint(path: str) -> str:
+    # Hash of the metadata of every entry. Any change of the content also changes mtime/ctime, so the content is not read.
+    # NOTE: ctime cannot be set by users, so tools which preserve mtime (e.g. rsync -t) don't hide changes
+    fingerprint = hashlib.blake2b(digest_size=16)
+    directories = [path]
+    while len(directories) > 0:
+        directory = directories.pop()
+        with os.scandir(directory) as entries:
+            # NOTE: The order of scandir is not guaranteed, even if nothing changed
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                entry_stat = entry.stat(follow_symlinks=False)
+                relative_path = os.path.relpath(entry.path, path)
+                fingerprint.update(os.fsencode(relative_path) + b"\0")
+                fingerprint.update(
+                    repr(
+                        (
+                            entry_stat.st_mode,
+                            entry_stat.st_uid,
+                            entry_stat.st_gid,
+                            entry_stat.st_size,
+                            entry_stat.st_ino,
+                            entry_stat.st_mtime_ns,
+                            entry_stat.st_ctime_ns,
+                        )
+                    ).encode("ascii")
+                )
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+    return fingerprint.hexdigest()
+
+
+def same_content(path1: str, path2: str) -> bool:
+    with open(path1, "rb") as file1, open(path2, "rb") as file2:
+        while True:
+            chunk1 = file1.read(1024 * 1024)
+            if chunk1 != file2.read(1024 * 1024):
+                return False
+            if len(chunk1) == 0:
+                return True
+
+
+def is_unchanged(
+    source: str, source_stat: os.stat_result, target: str, target_stat: os.stat_result
+) -> bool:
+    if stat.S_IFMT(source_stat.st_mode) != stat.S_IFMT(target_stat.st_mode):
+        return False
+    if stat.S_ISLNK(source_stat.st_mode):
+        return os.readlink(source) == os.readlink(target)
+    if not stat.S_ISREG(source_stat.st_mode):
+        return False
+    if source_stat.st_size != target_stat.st_size:
+        return False
+    # NOTE: The modification time is not enough, duplicity only keeps seconds and files can be changed within the same second
+    return same_content(source, target)
+
+
+def copy_metadata(source_stat: os.stat_result, target: str):
+    os.chown(target, source_stat.st_uid, source_stat.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(source_stat.st_mode):
+        os.chmod(target, stat.S_IMODE(source_stat.st_mode))
+    os.utime(
+        target,
+        ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns),
+        follow_symlinks=False,
+    )
+
+
+def clone_file(source: str, target: str):
+    with open(source, "rb") as source_file, open(target, "wb") as target_file:
+        try:
+            # A reflink only copies metadata, so it takes no time and no space
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+            return
+        except OSError:
+            pass
+        try:
+            # NOTE: Also shares the blocks on some filesystems, otherwise it at least copies inside the kernel
+            while (
+                os.copy_file_range(source_file.fileno(), target_file.fileno(), 1 << 30)
+                > 0
+            ):
+                pass
+        except OSError:
+            # Older kernels don't support copying between filesystems
+            source_file.seek(0)
+            target_file.seek(0)
+            target_file.truncate()
+            shutil.copyfileobj(source_file, target_file, 1024 * 1024)
+
+
+def snapshot_directory(
+    source: str, target: str, links: Optional[dict[tuple[int, int], str]] = None
+) -> int:
+    # Copies source to target with all owners, permissions and modification times, returns the number of copied entries
+    # links maps (device, inode) of files with hard links to their copy, so every file is only copied once
+    if links is None:
+        links = {}
+    copied = 0
+    os.mkdir(target)
+    with os.scandir(source) as entries:
+        for entry in entries:
+            target_path = os.path.join(target, entry.name)
+            entry_stat = entry.stat(follow_symlinks=False)
+            if entry.is_dir(follow_symlinks=False):
+                copied += snapshot_directory(entry.path, target_path, links)
+            elif entry.is_symlink():
+                os.symlink(os.readlink(entry.path), target_path)
+            elif (entry_stat.st_dev, entry_stat.st_ino) in links:
+                os.link(links[(entry_stat.st_dev, entry_stat.st_ino)], target_path)
+            elif entry.is_file(follow_symlinks=False):
+                clone_file(entry.path, target_path)
+                if entry_stat.st_nlink > 1:
+                    links[(entry_stat.st_dev, entry_stat.st_ino)] = target_path
+            else:
+                os.mknod(target_path, entry_stat.st_mode, entry_stat.st_rdev)
+            if not entry.is_dir(follow_symlinks=False):
+                copy_metadata(entry_stat, target_path)
+            copied += 1
+    # NOTE: After the content, otherwise the modification time changes again
+    copy_metadata(os.lstat(source), target)
+    return copied
+
+
+def remove_path(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def sync_directory(
+    source: str,
+    target: str,
+    exclude: frozenset[str] = frozenset(),
+    statistics: Optional[dict[str, int]] = None,
+) -> dict[str, int]:
+    # Makes target equal to source, but only touches entries which differ
+    # Changed entries are moved from source, so this only works on the same filesystem
+    if statistics is None:
+        statistics = {"unchanged": 0, "replaced": 0, "removed": 0}
+
+    with os.scandir(source) as entries:
+        source_entries = {entry.name: entry for entry in entries}
+
+    with os.scandir(target) as entries:
+        for entry in entries:
+            if entry.name not in exclude and entry.name not in source_entries:
+                remove_path(entry.path)
+                statistics["removed"] += 1
+
+    for name, entry in source_entries.items():
+        target_path = os.path.join(target, name)
+        source_stat = entry.stat(follow_symlinks=False)
+        try:
+            target_stat: Optional[os.stat_result] = os.lstat(target_path)
+        except FileNotFoundError:
+            target_stat = None
+
+        if (
+            entry.is_dir(follow_symlinks=False)
+            and target_stat is not None
+            and stat.S_ISDIR(target_stat.st_mode)
+        ):
+            sync_directory(entry.path, target_path, frozenset(), statistics)
+            copy_metadata(source_stat, target_path)
+        elif target_stat is not None and is_unchanged(
+            entry.path, source_stat, target_path, target_stat
+        ):
+            if (
+                source_stat.st_mode,
+                source_stat.st_uid,
+                source_stat.st_gid,
+                int(source_stat.st_mtime),
+            ) != (
+                target_stat.st_mode,
+                target_stat.st_uid,
+                target_stat.st_gid,
+                int(target_stat.st_mtime),
+            ):
+                copy_metadata(source_stat, target_path)
+            statistics["unchanged"] += 1
+        else:
+            if target_stat is not None:
+                remove_path(target_path)
+            os.rename(entry.path, target_path)
+            statistics["replaced"] += 1
+
+    return statistics
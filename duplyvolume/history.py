@@ -0,0 +1,217 @@
+import json
+import logging
+import math
+import os
+from datetime import datetime
+from typing import NotRequired, Optional, TypedDict
+
+from .config import config
+from .utils import format_size
+
+# The runner sends its timings through its log output, the control container collects them (see start_runner)
+history_logger = logging.getLogger(f"{__package__}.history")
+
+# A run is flagged if a volume took this much longer than the median of its earlier runs
+REGRESSION_FACTOR = 1.5
+# Differences below this (in seconds) are noise and never flagged
+REGRESSION_MIN_SECONDS = 5
+# Earlier runs which are needed before a volume can be flagged
+REGRESSION_MIN_RUNS = 3
+PHASES = ["stop", "snapshot", "duplicity", "remove", "start"]
+# Only these statistics of duplicity are kept, to keep the history compact
+STATISTICS = [
+    "SourceFiles",
+    "SourceFileSize",
+    "NewFiles",
+    "ChangedFiles",
+    "DeletedFiles",
+    "TotalDestinationSizeChange",
+]
+
+
+class VolumeRun(TypedDict):
+    # Phase ("stop", "duplicity", ...) -> seconds
+    phases: dict[str, float]
+    # Statistics of duplicity, see STATISTICS
+    statistics: NotRequired[dict[str, float]]
+    skipped: NotRequired[bool]
+
+
+class Run(TypedDict):
+    command: str
+    started_at: str
+    result: NotRequired[str]
+    # Seconds needed to inspect all containers and volumes
+    inventory: NotRequired[float]
+    volumes: dict[str, VolumeRun]
+
+
+# The run of the control container which currently holds the task lock
+current_run: Optional[Run] = None
+
+
+def history_path() -> str:
+    return os.path.join(config.state_dir, "history.jsonl")
+
+
+def record_phase(volume_name: str, phase: str, seconds: float):
+    history_logger.info(
+        json.dumps({"volume": volume_name, "phase": phase, "seconds": seconds})
+    )
+
+
+def record_statistics(volume_name: str, statistics: dict[str, float]):
+    statistics = {k: v for k, v in statistics.items() if k in STATISTICS}
+    history_logger.info(json.dumps({"volume": volume_name, "statistics": statistics}))
+
+
+def record_skipped(volume_name: str):
+    history_logger.info(json.dumps({"volume": volume_name, "skipped": True}))
+
+
+def apply_history_message(message: str):
+    if current_run is None:
+        return
+    entry = json.loads(message)
+    volume_run = current_run["volumes"].setdefault(entry["volume"], {"phases": {}})
+    if "phase" in entry:
+        # NOTE: Phases can happen more than once per volume (e.g. remove and restore)
+        volume_run["phases"][entry["phase"]] = round(
+            volume_run["phases"].get(entry["phase"], 0) + entry["seconds"], 3
+        )
+    if "statistics" in entry:
+        volume_run["statistics"] = entry["statistics"]
+    if "skipped" in entry:
+        volume_run["skipped"] = entry["skipped"]
+
+
+class HistoryHandler(logging.Handler):
+    def emit(self, record):
+        apply_history_message(record.getMessage())
+
+
+def install_history_handler():
+    # Only in the control container. Timings are stored instead of logged.
+    history_logger.addHandler(HistoryHandler())
+    history_logger.propagate = False
+
+
+def start_run(command: str):
+    global current_run
+    current_run = {
+        "command": command,
+        "started_at": datetime.now().isoformat(sep=" ", timespec="seconds"),
+        "volumes": {},
+    }
+
+
+def record_inventory(seconds: float):
+    if current_run is not None:
+        current_run["inventory"] = round(seconds, 3)
+
+
+def finish_run(result: str):
+    global current_run
+    run = current_run
+    current_run = None
+    # Runs which did nothing don't say anything about performance
+    if run is None or len(run["volumes"]) == 0:
+        return
+    run["result"] = result
+    os.makedirs(config.state_dir, exist_ok=True)
+    # NOTE: One line per run, so appending never has to rewrite the file
+    with open(history_path(), "a") as file:
+        file.write(json.dumps(run, separators=(",", ":")) + "\n")
+
+
+def read_history() -> list[Run]:
+    try:
+        with open(history_path(), "r") as file:
+            return [json.loads(line) for line in file if line.strip() != ""]
+    except FileNotFoundError:
+        return []
+
+
+def percentile(values: list[float], p: float) -> float:
+    # Nearest-rank percentile
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def volume_duration(volume_run: VolumeRun) -> float:
+    return sum(volume_run["phases"].values())
+
+
+def render_report(command: str = "backup") -> str:
+    runs = [
+        run
+        for run in read_history()
+        if run["command"] == command and run.get("result") == "success"
+    ]
+    if len(runs) == 0:
+        return f"No successful {command} runs recorded yet\n"
+
+    # Volume name -> its runs, oldest first
+    durations: dict[str, list[VolumeRun]] = {}
+    for run in runs:
+        for volume_name, volume_run in run["volumes"].items():
+            if not volume_run.get("skipped", False):
+                durations.setdefault(volume_name, []).append(volume_run)
+
+    lines = [
+        f"{len(runs)} successful {command} runs since {runs[0]['started_at'][0:16]}, last one at {runs[-1]['started_at'][0:16]}",
+        "",
+        f"{'Volume':<40} {'Runs':>5} {'p50':>9} {'p90':>9} {'Max':>9} {'Last':>9} {'Trend':>7} {'Read':>10} {'Sent':>10} {'Changed':>8}",
+    ]
+    regressions = []
+    for volume_name, volume_runs in sorted(
+        durations.items(),
+        key=lambda item: percentile([volume_duration(r) for r in item[1]], 50),
+        reverse=True,
+    ):
+        totals = [volume_duration(volume_run) for volume_run in volume_runs]
+        previous = totals[:-1]
+        trend = (
+            f"{(totals[-1] / percentile(previous, 50) - 1) * 100:+.0f}%"
+            if len(previous) > 0 and percentile(previous, 50) > 0
+            else "-"
+        )
+        # Bytes and files of the last run
+        statistics = volume_runs[-1].get("statistics", {})
+        changed_files = sum(
+            statistics.get(k, 0) for k in ["NewFiles", "ChangedFiles", "DeletedFiles"]
+        )
+        lines.append(
+            f"{volume_name:<40} {len(totals):>5} {percentile(totals, 50):>8.1f}s {percentile(totals, 90):>8.1f}s {max(totals):>8.1f}s {totals[-1]:>8.1f}s {trend:>7} {format_size(statistics.get('SourceFileSize', 0)):>10} {format_size(statistics.get('TotalDestinationSizeChange', 0)):>10} {changed_files:>8.0f}"
+        )
+
+        if len(previous) < REGRESSION_MIN_RUNS:
+            continue
+        # Compare every phase separately, so the report tells where the time went
+        for phase in PHASES:
+            phase_previous = [
+                volume_run["phases"].get(phase, 0) for volume_run in volume_runs[:-1]
+            ]
+            phase_last = volume_runs[-1]["phases"].get(phase, 0)
+            phase_median = percentile(phase_previous, 50)
+            if (
+                phase_last > phase_median * REGRESSION_FACTOR
+                and phase_last - phase_median >= REGRESSION_MIN_SECONDS
+            ):
+                regressions.append(
+                    f"{volume_name}: {phase} took {phase_last:.1f}s in the last run, the median was {phase_median:.1f}s"
+                )
+
+    inventory_times = [run["inventory"] for run in runs if "inventory" in run]
+    if len(inventory_times) > 0:
+        lines.append("")
+        lines.append(
+            f"Inventory: p50 {percentile(inventory_times, 50):.2f}s, p90 {percentile(inventory_times, 90):.2f}s, last {inventory_times[-1]:.2f}s"
+        )
+    lines.append("")
+    if len(regressions) > 0:
+        lines.append("Regressions:")
+        lines.extend(regressions)
+    else:
+        lines.append("No regressions")
+    return "\n".join(lines) + "\n"
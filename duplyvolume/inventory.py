@@ -0,0 +1,177 @@
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+import asyncio
+import aiodocker
+from aiodocker.containers import DockerContainer
+
+from .config import config
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Inventory:
+    # Container id -> container as returned by containers.get
+    containers: dict[str, DockerContainer]
+    # Volume name -> volume info as returned by the API (Name, Labels, ...)
+    volumes: dict[str, dict]
+    # How long it took to load the inventory in seconds
+    duration: float
+
+
+# Kept up to date by watch_inventory, None if the event stream is not connected
+cached_inventory: Optional[Inventory] = None
+
+# Container events which can change the inspected data, everything else (exec_*, health_status, ...) is ignored
+CONTAINER_ACTIONS = {"create", "start", "die", "rename", "update", "destroy"}
+
+
+async def load_inventory(
+    client: aiodocker.Docker, skip_removed: bool = False
+) -> Inventory:
+    start_time = time.monotonic()
+    semaphore = asyncio.Semaphore(config.api_concurrency)
+
+    async def get_container(container_id: str) -> Optional[DockerContainer]:
+        async with semaphore:
+            try:
+                # NOTE: containers.list does not return the full config
+                return await client.containers.get(container_id)
+            except aiodocker.DockerError as e:
+                if skip_removed and e.status == 404:
+                    # The container was removed since the call to .list()
+                    return None
+                raise
+
+    container_ids = [
+        container.id for container in await client.containers.list(all=True)
+    ]
+    containers, volume_list = await asyncio.gather(
+        asyncio.gather(
+            *(get_container(container_id) for container_id in container_ids)
+        ),
+        client.volumes.list(),
+    )
+    inventory = Inventory(
+        containers={
+            container.id: container for container in containers if container is not None
+        },
+        volumes={
+            volume["Name"]: volume
+            # NOTE: Volumes can be null if there are no volumes
+            for volume in volume_list["Volumes"] or []
+        },
+        duration=time.monotonic() - start_time,
+    )
+    logger.debug(
+        f"Loaded {len(inventory.containers)} containers and {len(inventory.volumes)} volumes in {inventory.duration:.2f}s"
+    )
+    return inventory
+
+
+async def inspect_missing_volumes(client: aiodocker.Docker, inventory: Inventory):
+    # Containers can mount volumes which are not in the inventory yet (created after volumes.list or before its event arrived)
+    missing_volumes = {
+        mount["Name"]
+        for container in inventory.containers.values()
+        for mount in container["Mounts"]
+        if mount["Type"] == "volume" and mount["Name"] not in inventory.volumes
+    }
+    semaphore = asyncio.Semaphore(config.api_concurrency)
+
+    async def inspect_volume(volume_name: str):
+        async with semaphore:
+            try:
+                inventory.volumes[volume_name] = await (
+                    await client.volumes.get(volume_name)
+                ).show()
+            except aiodocker.DockerError as e:
+                if e.status != 404:
+                    raise
+                # The volume was removed in the meantime, it is skipped by the caller
+                logger.debug(f"Volume {volume_name} was removed in the meantime")
+
+    await asyncio.gather(
+        *(inspect_volume(volume_name) for volume_name in missing_volumes)
+    )
+
+
+async def get_inventory(
+    client: aiodocker.Docker, skip_removed: bool = False
+) -> Inventory:
+    if cached_inventory is None:
+        inventory = await load_inventory(client, skip_removed)
+    else:
+        # Copy, so the caller works with one snapshot even if events arrive in the meantime
+        start_time = time.monotonic()
+        inventory = Inventory(
+            containers=dict(cached_inventory.containers),
+            volumes=dict(cached_inventory.volumes),
+            duration=time.monotonic() - start_time,
+        )
+    await inspect_missing_volumes(client, inventory)
+    return inventory
+
+
+async def apply_event(client: aiodocker.Docker, inventory: Inventory, event: dict):
+    actor_id = event["Actor"]["ID"]
+    if event["Type"] == "container" and event["Action"] in CONTAINER_ACTIONS:
+        if event["Action"] == "destroy":
+            inventory.containers.pop(actor_id, None)
+            return
+        try:
+            inventory.containers[actor_id] = await client.containers.get(actor_id)
+        except aiodocker.DockerError as e:
+            if e.status != 404:
+                raise
+            # The container was removed in the meantime, the destroy event will follow
+            inventory.containers.pop(actor_id, None)
+    elif event["Type"] == "volume" and event["Action"] == "create":
+        try:
+            inventory.volumes[actor_id] = await (
+                await client.volumes.get(actor_id)
+            ).show()
+        except aiodocker.DockerError as e:
+            if e.status != 404:
+                raise
+    elif event["Type"] == "volume" and event["Action"] == "destroy":
+        inventory.volumes.pop(actor_id, None)
+
+
+async def watch_inventory(
+    on_volumes_change: Optional[Callable[[dict[str, dict]], None]] = None,
+):
+    # on_volumes_change is called with all volumes when they are loaded and whenever a volume is created or removed
+    global cached_inventory
+    while True:
+        try:
+            # NOTE: A new client is necessary for every connection, the event stream of a client cannot be restarted
+            async with aiodocker.Docker() as client:
+                # NOTE: Subscribe before loading the inventory and replay events since now, otherwise events in between could get lost
+                subscriber = client.events.subscribe(
+                    since=str(int(time.time())),
+                    filters=json.dumps({"type": ["container", "volume"]}),
+                )
+                inventory = await load_inventory(client, skip_removed=True)
+                cached_inventory = inventory
+                if on_volumes_change is not None:
+                    on_volumes_change(inventory.volumes)
+                while True:
+                    event = await subscriber.get()
+                    if event is None:
+                        raise Exception("Docker event stream closed")
+                    await apply_event(client, inventory, event)
+                    if on_volumes_change is not None and event["Type"] == "volume":
+                        on_volumes_change(inventory.volumes)
+        except Exception:
+            logger.warning(
+                "Lost connection to the Docker event stream, retrying in 10s",
+                exc_info=True,
+            )
+        finally:
+            # Fall back to loading the inventory on demand
+            cached_inventory = None
+        await asyncio.sleep(10)
@@ -0,0 +1,101 @@
+import json
+import logging
+import os
+from datetime import datetime
+from typing import TypedDict
+import aiodocker
+
+from .config import config
+from .metrics import record_metric
+
+logger = logging.getLogger(__name__)
+# The runner writes the journal through its log output, the control container stores it (see start_runner)
+journal_logger = logging.getLogger(f"{__package__}.journal")
+
+
+class JournalEntry(TypedDict):
+    name: str
+    # ISO timestamp of the moment before the container was stopped
+    stopped_at: str
+
+
+def journal_path() -> str:
+    return os.path.join(config.state_dir, "restart-journal.json")
+
+
+def read_journal() -> dict[str, JournalEntry]:
+    try:
+        with open(journal_path(), "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def write_journal(journal: dict[str, JournalEntry]):
+    os.makedirs(config.state_dir, exist_ok=True)
+    # Write to a temporary file first, so a crash never leaves a partially written journal
+    with open(f"{journal_path()}.tmp", "w") as file:
+        json.dump(journal, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f"{journal_path()}.tmp", journal_path())
+    record_metric("duplyvolume_stopped_containers", {}, len(journal))
+
+
+def record_stop(container_id: str, name: str):
+    # NOTE: Called before the container is stopped, so a crash during the stop is not missed
+    journal_logger.info(
+        json.dumps(
+            {
+                "action": "stop",
+                "id": container_id,
+                "name": name,
+                "time": datetime.now().isoformat(),
+            }
+        )
+    )
+
+
+def record_start(container_id: str):
+    journal_logger.info(json.dumps({"action": "start", "id": container_id}))
+
+
+def apply_journal_message(message: str):
+    entry = json.loads(message)
+    journal = read_journal()
+    if entry["action"] == "stop":
+        journal[entry["id"]] = {"name": entry["name"], "stopped_at": entry["time"]}
+    elif entry["action"] == "start":
+        journal.pop(entry["id"], None)
+    write_journal(journal)
+
+
+async def replay_journal(client: aiodocker.Docker):
+    # Start containers which are still stopped because a runner did not finish (e.g. OOM kill or reboot)
+    # NOTE: Must not run while a runner is active, it would start the containers it just stopped
+    journal = read_journal()
+    if len(journal) == 0:
+        return
+    for container_id, entry in list(journal.items()):
+        try:
+            target_container = await client.containers.get(container_id)
+            if target_container["State"]["Status"] != "running":
+                await target_container.start()
+                downtime = datetime.now() - datetime.fromisoformat(entry["stopped_at"])
+                record_metric(
+                    "duplyvolume_container_downtime_seconds",
+                    {"container": entry["name"]},
+                    downtime.total_seconds(),
+                    add=True,
+                )
+                logger.warning(
+                    f"Started container {entry['name']}, it was stopped by an interrupted backup/restore for {downtime.total_seconds():.0f}s"
+                )
+        except aiodocker.DockerError as e:
+            if e.status != 404:
+                raise
+            logger.warning(
+                f"Container {entry['name']} was stopped by an interrupted backup/restore and has been removed since"
+            )
+        del journal[container_id]
+        write_journal(journal)
@@ -1,13 +1,13 @@
 import json
 import logging
+import shlex
 import sys
 import argparse
 import asyncio
 import signal
 
 from .ipc import send_command_to_control
-from .control import control
-from .runner_tasks import backup_stage2, restore_stage2
+from .utils import install_log_prefix
 
 logger = logging.getLogger(__name__)
 
@@ -18,26 +18,53 @@ def main():
 
     logging.basicConfig()
     logging.getLogger(__package__).setLevel(logging.INFO)
+    install_log_prefix()
 
     parser = argparse.ArgumentParser()
     parser.add_argument("command", type=str, help="The command to execute")
-    parser.add_argument("data", type=json.loads, nargs="?", help=argparse.SUPPRESS)
+    parser.add_argument(
+        "selectors",
+        type=str,
+        nargs="*",
+        help="Only back up/restore volumes matching a name, a glob pattern or label=<key>[=<value>]",
+    )
 
     # NOTE: Not in async code because parse_args can call sys.exit
     args = parser.parse_args()
 
     # NOTE: If asyncio.run is interrupted once, it cancels all tasks and waits for them
     try:
+        # NOTE: Only import the control and runner code (and aiodocker, pydantic, ...) if it is needed
+        # Commands like healthcheck only send a command to the control container and run very often
         if args.command == "control":
+            from .control import control
+
             asyncio.run(control())
-        elif args.command == "backup-stage2" and args.data is not None:
-            asyncio.run(backup_stage2(args.data))
-        elif args.command == "restore-stage2" and args.data is not None:
-            asyncio.run(restore_stage2(args.data))
+        elif args.command == "backup-stage2" and len(args.selectors) == 1:
+            from .runner_tasks import backup_stage2
+
+            # NOTE: The runner receives the volume map as JSON instead of selectors
+            asyncio.run(backup_stage2(json.loads(args.selectors[0])))
+        elif args.command == "restore-stage2" and len(args.selectors) == 1:
+            from .runner_tasks import restore_stage2
+
+            asyncio.run(restore_stage2(json.loads(args.selectors[0])))
+        elif args.command == "runner-pool":
+            from .runner_tasks import keep_runner_alive
+
+            keep_runner_alive()
         elif args.command == "backup":
-            asyncio.run(send_command_to_control("backup", interrupt="cancel"))
+            asyncio.run(
+                send_command_to_control(
+                    shlex.join(["backup", *args.selectors]), interrupt="cancel"
+                )
+            )
         elif args.command == "restore":
-            asyncio.run(send_command_to_control("restore", interrupt="cancel"))
+            asyncio.run(
+                send_command_to_control(
+                    shlex.join(["restore", *args.selectors]), interrupt="cancel"
+                )
+            )
         elif args.command == "healthcheck":
             # TODO: can this happen in the runner?
             result = asyncio.run(send_command_to_control("healthcheck"))
@@ -48,6 +75,17 @@ def main():
                 )
                 else 1
             )
+        elif args.command == "metrics":
+            print(asyncio.run(send_command_to_control("metrics", silent=True)), end="")
+        elif args.command == "report":
+            print(
+                asyncio.run(
+                    send_command_to_control(
+                        shlex.join(["report", *args.selectors]), silent=True
+                    )
+                ),
+                end="",
+            )
         elif args.command == "cancel":
             asyncio.run(send_command_to_control("cancel"))
         else:
@@ -1,89 +1,206 @@
-from boto3 import client
-from botocore.exceptions import ClientError
-from io import BytesIO
-from asyncio import to_thread
-from os import listdir
+import gzip
+import json
+from base64 import b64encode
+from functools import cache
+from hashlib import md5
+from asyncio import Lock, to_thread
+from datetime import datetime
+from os import listdir, replace
+from typing import AsyncIterator, NotRequired, Optional, TypedDict
 
 from .config import config
+from .metrics import record_metric
 
+MANIFEST_KEY = "duplyvolume.manifest.json.gz"
+MANIFEST_VERSION = 1
 
-async def write_metadata(volume_name: str, data: str):
-    # TODO: make this async
+# Serializes read-modify-write cycles of the manifest within this process
+manifest_lock = Lock()
+
+
+class ManifestVolume(TypedDict):
+    # Name/Labels of the volume, like the content of <volume>.metadata
+    metadata: NotRequired[dict]
+    # ISO timestamp of the last successful backup
+    last_backup: NotRequired[str]
+    # ISO timestamp of the last full backup, see FULL_IF_OLDER_THAN
+    last_full_backup: NotRequired[str]
+    # Backup statistics reported by duplicity (SourceFiles, SourceFileSize, ElapsedTime, ...)
+    statistics: NotRequired[dict[str, float]]
+    # Fingerprint of the volume content at the last backup, see fs_utils.tree_fingerprint
+    fingerprint: NotRequired[str]
+
+
+class Manifest(TypedDict):
+    version: int
+    volumes: dict[str, ManifestVolume]
+
+
+@cache
+def s3_client():
+    # NOTE: boto3 takes long to import, so it is only imported if S3 is used
+    from boto3 import client
+    from botocore.config import Config as BotoConfig
+
+    # NOTE: Clients are thread-safe, so all requests of this process share one client and its connection pool
+    # NOTE: Pass credentials explicitly because boto does not support _FILE env convention
+    return client(
+        "s3",
+        region_name=config.s3_region_code,
+        endpoint_url=config.s3_endpoint_url,
+        aws_access_key_id=config.aws_access_key_id,
+        aws_secret_access_key=config.aws_secret_access_key,
+        config=BotoConfig(max_pool_connections=config.api_concurrency),
+    )
+
+
+def read_file(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_file(path: str, data: bytes):
+    # Write to a temporary file first, so readers never see a partially written file
+    with open(f"{path}.tmp", "wb") as file:
+        file.write(data)
+    replace(f"{path}.tmp", path)
+
+
+async def read_object(key: str) -> Optional[bytes]:
+    if config.s3_bucket_name is None:
+        return await to_thread(read_file, f"/target/{key}")
+    else:
+        from botocore.exceptions import ClientError
+
+        try:
+            response = await to_thread(
+                s3_client().get_object, Bucket=config.s3_bucket_name, Key=key
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise
+        return await to_thread(response["Body"].read)
+
+
+async def write_object(key: str, data: bytes, storage_class: str):
     if config.s3_bucket_name is None:
-        with open(f"/target/{volume_name}.metadata", "w") as file:
-            file.write(data)
+        await to_thread(write_file, f"/target/{key}", data)
     else:
+        from botocore.exceptions import ClientError
+
+        data_md5 = md5(data)
         try:
             # Don't overwrite unless necessary. Otherwise we would violate the 30-day-minimum-lifetime of STANDARD_IA.
-            if await read_metadata(volume_name) == data:
+            # NOTE: The ETag is only the MD5 of unencrypted single part uploads, that's why the MD5 is also stored as object metadata
+            response = await to_thread(
+                s3_client().head_object, Bucket=config.s3_bucket_name, Key=key
+            )
+            if data_md5.hexdigest() in {
+                response["ETag"].strip('"'),
+                response["Metadata"].get("md5"),
+            }:
                 return
         except ClientError as e:
             error_code = e.response["Error"]["Code"]
-            # If a 404 occurs this is a new metadata file. Continue normally.
+            # If a 404 occurs this is a new file. Continue normally.
             if error_code != "404":
                 # Otherwise re-raise the exception
                 raise
-        # NOTE: Pass credentials explicitly because boto does not support _FILE env convention
-        s3 = client(
-            "s3",
-            region_name=config.s3_region_code,
-            endpoint_url=config.s3_endpoint_url,
-            aws_access_key_id=config.aws_access_key_id,
-            aws_secret_access_key=config.aws_secret_access_key,
-        )
-        s3.upload_fileobj(
-            BytesIO(data.encode("utf8")),
-            config.s3_bucket_name,
-            f"{volume_name}.metadata",
-            ExtraArgs={"StorageClass": config.s3_storage_class},
+        await to_thread(
+            s3_client().put_object,
+            Bucket=config.s3_bucket_name,
+            Key=key,
+            Body=data,
+            ContentMD5=b64encode(data_md5.digest()).decode("ascii"),
+            Metadata={"md5": data_md5.hexdigest()},
+            StorageClass=storage_class,
         )
 
 
-async def list_volumes_by_metadata():
-    if config.s3_bucket_name is None:
-        return [
-            file_name[: -len(".metadata")]
-            for file_name in await to_thread(listdir, "/target")
-            if file_name.endswith(".metadata")
-        ]
-    else:
-        # TODO: make this async
-        # NOTE: Pass credentials explicitly because boto does not support _FILE env convention
-        s3 = client(
-            "s3",
-            region_name=config.s3_region_code,
-            endpoint_url=config.s3_endpoint_url,
-            aws_access_key_id=config.aws_access_key_id,
-            aws_secret_access_key=config.aws_secret_access_key,
-        )
-        response = s3.list_objects_v2(Bucket=config.s3_bucket_name, Delimiter="/")
-        if response["IsTruncated"]:
-            raise Exception("Too many results during list volumes")
-        return [
-            obj["Key"][: -len(".metadata")]
-            for obj in response["Contents"]
-            if obj["Key"].endswith(".metadata")
-        ]
-
-
-async def read_metadata(volume_name: str) -> str:
-    # TODO: make this async
+async def write_metadata(volume_name: str, data: str):
+    await write_object(
+        f"{volume_name}.metadata", data.encode("utf8"), config.s3_storage_class
+    )
+
+
+async def list_metadata_files() -> AsyncIterator[str]:
     if config.s3_bucket_name is None:
-        with open(f"/target/{volume_name}.metadata", "r") as file:
-            return file.read()
+        for file_name in await to_thread(listdir, "/target"):
+            if file_name.endswith(".metadata"):
+                yield file_name[: -len(".metadata")]
     else:
-        # NOTE: Pass credentials explicitly because boto does not support _FILE env convention
-        s3 = client(
-            "s3",
-            region_name=config.s3_region_code,
-            endpoint_url=config.s3_endpoint_url,
-            aws_access_key_id=config.aws_access_key_id,
-            aws_secret_access_key=config.aws_secret_access_key,
+        # NOTE: Volume contents are stored below "<volume>/", the delimiter keeps them out of the listing
+        pages = iter(
+            s3_client()
+            .get_paginator("list_objects_v2")
+            .paginate(Bucket=config.s3_bucket_name, Delimiter="/")
         )
-        dest = BytesIO()
-        s3.download_fileobj(
-            config.s3_bucket_name,
-            f"{volume_name}.metadata",
-            dest,
-        )
-        return dest.getvalue().decode("utf8")
+        # Yield the volumes of every page as soon as it arrives
+        while (page := await to_thread(next, pages, None)) is not None:
+            for obj in page.get("Contents", []):
+                if obj["Key"].endswith(".metadata"):
+                    yield obj["Key"][: -len(".metadata")]
+
+
+async def list_volumes_by_metadata(
+    manifest: Optional[Manifest] = None,
+) -> AsyncIterator[str]:
+    manifest_volume_names: set[str] = set()
+    if manifest is not None:
+        for volume_name, volume in manifest["volumes"].items():
+            if "metadata" in volume:
+                manifest_volume_names.add(volume_name)
+                yield volume_name
+    # NOTE: Volumes which were not backed up since METADATA_MANIFEST was enabled (e.g. with selectors or their own schedule) only have a metadata file
+    async for volume_name in list_metadata_files():
+        if volume_name not in manifest_volume_names:
+            yield volume_name
+
+
+async def read_metadata(volume_name: str, manifest: Optional[Manifest] = None) -> str:
+    if manifest is not None and "metadata" in manifest["volumes"].get(volume_name, {}):
+        return json.dumps(manifest["volumes"][volume_name]["metadata"])
+    data = await read_object(f"{volume_name}.metadata")
+    if data is None:
+        raise Exception(f"No metadata found for volume {volume_name}")
+    return data.decode("utf8")
+
+
+async def read_manifest() -> Manifest:
+    data = await read_object(MANIFEST_KEY)
+    if data is None:
+        return {"version": MANIFEST_VERSION, "volumes": {}}
+    manifest = json.loads(gzip.decompress(data))
+    if manifest["version"] != MANIFEST_VERSION:
+        raise Exception(f"Unsupported manifest version {manifest['version']}")
+    return manifest
+
+
+async def write_manifest(manifest: Manifest):
+    # NOTE: mtime=0 makes the output deterministic, so an unchanged manifest is not uploaded again
+    data = gzip.compress(json.dumps(manifest, sort_keys=True).encode("utf8"), mtime=0)
+    # NOTE: The manifest changes after every backup, STANDARD_IA would charge the minimum lifetime for every version
+    await write_object(MANIFEST_KEY, data, "STANDARD")
+
+
+async def record_backups(backups: dict[str, ManifestVolume]):
+    async with manifest_lock:
+        manifest = await read_manifest()
+        for volume_name, backup in backups.items():
+            manifest["volumes"].setdefault(volume_name, {}).update(backup)
+        await write_manifest(manifest)
+    for volume_name, backup in backups.items():
+        if "last_backup" in backup:
+            record_backup_metric(volume_name, backup["last_backup"])
+
+
+def record_backup_metric(volume_name: str, last_backup: str):
+    record_metric(
+        "duplyvolume_last_backup_timestamp_seconds",
+        {"volume": volume_name},
+        datetime.fromisoformat(last_backup).timestamp(),
+    )
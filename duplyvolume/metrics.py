@@ -0,0 +1,110 @@
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import Literal
+
+# The runner sends metrics through its log output, the control container collects them (see start_runner)
+metrics_logger = logging.getLogger(f"{__package__}.metrics")
+
+
+@dataclass
+class MetricFamily:
+    type: Literal["gauge"] | Literal["counter"]
+    help: str
+    # Sorted label pairs -> value
+    samples: dict[tuple[tuple[str, str], ...], float] = field(default_factory=dict)
+
+
+registry: dict[str, MetricFamily] = {
+    "duplyvolume_last_backup_timestamp_seconds": MetricFamily(
+        "gauge", "Time of the last successful backup of a volume"
+    ),
+    "duplyvolume_backup_duration_seconds": MetricFamily(
+        "gauge", "Duration of the last backup of a volume"
+    ),
+    "duplyvolume_backup_source_bytes": MetricFamily(
+        "gauge", "Size of a volume at its last backup"
+    ),
+    "duplyvolume_backup_transferred_bytes": MetricFamily(
+        "gauge", "Bytes added to the target by the last backup of a volume"
+    ),
+    "duplyvolume_transferred_bytes": MetricFamily(
+        "counter", "Bytes added to the target by backups of a volume"
+    ),
+    "duplyvolume_restore_duration_seconds": MetricFamily(
+        "gauge", "Duration of the last restore of a volume"
+    ),
+    "duplyvolume_container_downtime_seconds": MetricFamily(
+        "counter", "Time a container was stopped by backups/restores"
+    ),
+    "duplyvolume_last_container_downtime_seconds": MetricFamily(
+        "gauge", "Time a container was stopped by the last backup/restore"
+    ),
+    "duplyvolume_duplicity_exits": MetricFamily(
+        "counter", "Finished duplicity processes by command and exit code"
+    ),
+    "duplyvolume_hook_duration_seconds": MetricFamily(
+        "gauge", "Duration of the last pre_exec/post_exec hook of a container"
+    ),
+    "duplyvolume_stopped_containers": MetricFamily(
+        "gauge", "Containers which are stopped by a backup/restore right now"
+    ),
+    "duplyvolume_queued_tasks": MetricFamily(
+        "gauge", "Backups/restores waiting for the running backup/restore"
+    ),
+    "duplyvolume_runner_peak_rss_bytes": MetricFamily(
+        "gauge", "Peak memory of the runner and of its largest duplicity process"
+    ),
+    "duplyvolume_runs": MetricFamily(
+        "counter", "Finished backups/restores by command and result"
+    ),
+}
+
+
+def record_metric(name: str, labels: dict[str, str], value: float, add: bool = False):
+    # Sets a gauge or adds to a counter (add=True), works in the runner and in the control container
+    metrics_logger.info(
+        json.dumps({"name": name, "labels": labels, "value": value, "add": add})
+    )
+
+
+def apply_metric_message(message: str):
+    metric = json.loads(message)
+    family = registry[metric["name"]]
+    key = tuple(sorted(metric["labels"].items()))
+    if metric["add"]:
+        family.samples[key] = family.samples.get(key, 0) + metric["value"]
+    else:
+        family.samples[key] = metric["value"]
+
+
+class MetricsHandler(logging.Handler):
+    def emit(self, record):
+        apply_metric_message(record.getMessage())
+
+
+def install_metrics_handler():
+    # Only in the control container. Metrics are stored instead of logged.
+    metrics_logger.addHandler(MetricsHandler())
+    metrics_logger.propagate = False
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics() -> str:
+    # OpenMetrics text format, see https://prometheus.io/docs/specs/om/open_metrics_spec/
+    lines = []
+    for name, family in registry.items():
+        lines.append(f"# TYPE {name} {family.type}")
+        lines.append(f"# HELP {name} {family.help}")
+        sample_name = f"{name}_total" if family.type == "counter" else name
+        for key, value in family.samples.items():
+            if len(key) > 0:
+                labels = ",".join(f'{k}="{escape_label_value(v)}"' for k, v in key)
+                lines.append(f"{sample_name}{{{labels}}} {value}")
+            else:
+                lines.append(f"{sample_name} {value}")
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
@@ -1,63 +1,381 @@
 import logging
+import asyncio
+import os
+import resource
+import signal
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
 import aiodocker
 
 from .config import config
 from .docker_utils import start_containers, stop_containers
-from .duplicity import do_backup, do_remove, do_restore
-from .utils import VolumeInfo
+from .duplicity import (
+    SNAPSHOT_DIRECTORY,
+    do_backup,
+    do_remove,
+    do_restore,
+    parse_time,
+)
+from .fs_utils import snapshot_directory, tree_fingerprint, wipe_directory
+from .history import record_phase, record_skipped, record_statistics
+from .metrics import record_metric
+from .metadata import ManifestVolume, read_manifest, record_backups
+from .utils import (
+    RestoreInfo,
+    VolumeInfo,
+    format_size,
+    gather_limited,
+    group_volumes,
+    prefix_logs,
+)
 
 logger = logging.getLogger(__name__)
 
+# Called by process_in_groups after the containers of a group are started again
+Continuation = Callable[[], Awaitable[None]]
+
+
+async def prepare_backup(volume_name: str) -> ManifestVolume:
+    # NOTE: The containers are stopped now, so this is the state which is backed up
+    backup: ManifestVolume = {"last_backup": datetime.now().isoformat()}
+    if config.skip_unchanged:
+        backup["fingerprint"] = await asyncio.to_thread(
+            tree_fingerprint, f"/source/{volume_name}"
+        )
+    return backup
+
+
+async def backup_volume(
+    volume_name: str,
+    volume_info: VolumeInfo,
+    backup: ManifestVolume,
+    source: Optional[str] = None,
+) -> ManifestVolume:
+    logger.info(f"Backing up volume {volume_name}")
+    start_time = time.monotonic()
+    backup["statistics"], last_full_backup = await do_backup(volume_name, source)
+    # NOTE: A full backup is recorded with the time the containers were stopped, like last_backup
+    backup["last_full_backup"] = (
+        backup["last_backup"]
+        if last_full_backup is None
+        else last_full_backup.isoformat()
+    )
+    duration = time.monotonic() - start_time
+    record_phase(volume_name, "duplicity", duration)
+    record_statistics(volume_name, backup["statistics"])
+    labels = {"volume": volume_name}
+    record_metric("duplyvolume_backup_duration_seconds", labels, duration)
+    record_metric(
+        "duplyvolume_backup_source_bytes",
+        labels,
+        backup["statistics"].get("SourceFileSize", 0),
+    )
+    transferred_bytes = backup["statistics"].get("TotalDestinationSizeChange", 0)
+    record_metric("duplyvolume_backup_transferred_bytes", labels, transferred_bytes)
+    record_metric("duplyvolume_transferred_bytes", labels, transferred_bytes, add=True)
+    await remove_old_backups(volume_name, volume_info)
+    return backup
+
+
+async def remove_old_backups(volume_name: str, volume_info: VolumeInfo):
+    remove_older_than = volume_info.get("remove_older_than", config.remove_older_than)
+    remove_all_but_n_full = volume_info.get(
+        "remove_all_but_n_full", config.remove_all_but_n_full
+    )
+    remove_all_inc_of_but_n_full = volume_info.get(
+        "remove_all_inc_of_but_n_full", config.remove_all_inc_of_but_n_full
+    )
+    if (
+        remove_older_than is not None
+        or remove_all_but_n_full is not None
+        or remove_all_inc_of_but_n_full is not None
+    ):
+        logger.info(f"Removing old backups from volume {volume_name}")
+        start_time = time.monotonic()
+        await do_remove(
+            volume_name,
+            remove_older_than,
+            remove_all_but_n_full,
+            remove_all_inc_of_but_n_full,
+        )
+        record_phase(volume_name, "remove", time.monotonic() - start_time)
+
+
+async def remove_snapshot(snapshot_path: str):
+    await wipe_directory(snapshot_path)
+    await asyncio.to_thread(os.rmdir, snapshot_path)
+
+
+async def take_snapshot(volume_name: str) -> str:
+    start_time = time.monotonic()
+    snapshot_path = f"{SNAPSHOT_DIRECTORY}/{volume_name}"
+    await asyncio.to_thread(os.makedirs, SNAPSHOT_DIRECTORY, exist_ok=True)
+    if await asyncio.to_thread(os.path.lexists, snapshot_path):
+        # Leftover of a failed backup
+        await remove_snapshot(snapshot_path)
+    copied = await asyncio.to_thread(
+        snapshot_directory, f"/source/{volume_name}", snapshot_path
+    )
+    duration = time.monotonic() - start_time
+    record_phase(volume_name, "snapshot", duration)
+    logger.info(
+        f"Took snapshot of volume {volume_name} with {copied} files and directories in {duration:.2f}s"
+    )
+    return snapshot_path
+
+
+def full_backup_due(volume: ManifestVolume) -> bool:
+    # Unchanged volumes still need their full backup, otherwise the chain of incremental backups would grow forever
+    if config.full_if_older_than is None:
+        return False
+    full_if_older_than = parse_time(config.full_if_older_than)
+    return (
+        full_if_older_than is None
+        or "last_full_backup" not in volume
+        or datetime.fromisoformat(volume["last_full_backup"]) < full_if_older_than
+    )
+
+
+async def skip_unchanged_volumes(
+    volume_map: dict[str, VolumeInfo],
+) -> tuple[dict[str, VolumeInfo], dict[str, ManifestVolume]]:
+    # Returns the changed volumes and the backups of the unchanged ones
+    # NOTE: This runs before any container is stopped. Volumes which are written right now have a different fingerprint anyway.
+    start_time = time.monotonic()
+    manifest = await read_manifest()
+    fingerprints = await gather_limited(
+        config.backup_concurrency,
+        (
+            asyncio.to_thread(tree_fingerprint, f"/source/{volume_name}")
+            for volume_name in volume_map.keys()
+        ),
+    )
+    changed_volume_map: dict[str, VolumeInfo] = {}
+    unchanged_backups: dict[str, ManifestVolume] = {}
+    for (volume_name, volume_info), fingerprint in zip(
+        volume_map.items(), fingerprints
+    ):
+        volume = manifest["volumes"].get(volume_name, {})
+        if volume.get("fingerprint") == fingerprint and not full_backup_due(volume):
+            logger.info(
+                f"Volume {volume_name} is unchanged since the last backup, skipping it"
+            )
+            # The last backup still has the current content, so the volume counts as backed up
+            unchanged_backups[volume_name] = {"last_backup": datetime.now().isoformat()}
+            record_skipped(volume_name)
+        else:
+            changed_volume_map[volume_name] = volume_info
+    logger.info(
+        f"Checked {len(volume_map)} volumes for changes in {time.monotonic() - start_time:.2f}s, {len(changed_volume_map)} changed"
+    )
+
+    async def remove_unchanged(volume_name: str):
+        with prefix_logs(volume_name if config.backup_concurrency > 1 else None):
+            await remove_old_backups(volume_name, volume_map[volume_name])
+
+    # Old backups of skipped volumes still expire
+    # NOTE: Their containers are not stopped, duplicity only removes old backup sets
+    await gather_limited(
+        config.backup_concurrency,
+        (remove_unchanged(volume_name) for volume_name in unchanged_backups.keys()),
+    )
+    return changed_volume_map, unchanged_backups
+
+
+async def process_in_groups(
+    client: aiodocker.Docker,
+    used_by_containers: dict[str, list[str]],
+    concurrency: int,
+    process_volume: Callable[[str], Awaitable[Optional[Continuation]]],
+    priorities: Optional[dict[str, int]] = None,
+    run_hooks: bool = False,
+):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process_group(volume_names: list[str]):
+        # Every container of a group is stopped exactly once. Groups never share containers, so they are independent.
+        group_containers = list(
+            {
+                container_id: None
+                for volume_name in volume_names
+                for container_id in used_by_containers[volume_name]
+            }
+        )
+        # Work which does not need stopped containers (e.g. backups from snapshots)
+        continuations: list[tuple[str, Continuation]] = []
+        async with semaphore:
+            try:
+                start_time = time.monotonic()
+                await stop_containers(client, group_containers, run_hooks)
+                # NOTE: The containers of a group are stopped together, every volume of the group gets the whole time
+                for volume_name in volume_names:
+                    record_phase(volume_name, "stop", time.monotonic() - start_time)
+                for volume_name in volume_names:
+                    # Only prefix logs if they can be interleaved
+                    with prefix_logs(volume_name if concurrency > 1 else None):
+                        continuation = await process_volume(volume_name)
+                    if continuation is not None:
+                        continuations.append((volume_name, continuation))
+            finally:
+                start_time = time.monotonic()
+                await start_containers(client, group_containers)
+                for volume_name in volume_names:
+                    record_phase(volume_name, "start", time.monotonic() - start_time)
+            for volume_name, continuation in continuations:
+                with prefix_logs(volume_name if concurrency > 1 else None):
+                    await continuation()
+
+    # NOTE: If one group fails, the TaskGroup cancels all other groups
+    async with asyncio.TaskGroup() as task_group:
+        # NOTE: Waiting tasks acquire the semaphore in the order they were created
+        for volume_names in group_volumes(used_by_containers, priorities):
+            task_group.create_task(process_group(volume_names))
+
+
+def log_backup_summary(backups: dict[str, ManifestVolume], duration: float):
+    # Show which volumes took the most time, based on the statistics of duplicity
+    statistics = {
+        volume_name: backup.get("statistics", {})
+        for volume_name, backup in backups.items()
+    }
+    logger.info(
+        f"Backed up {len(backups)} volumes ({format_size(sum(s.get('SourceFileSize', 0) for s in statistics.values()))} read) in {duration:.2f}s, slowest first:"
+    )
+    for volume_name, volume_statistics in sorted(
+        statistics.items(),
+        key=lambda item: item[1].get("ElapsedTime", 0),
+        reverse=True,
+    ):
+        elapsed = volume_statistics.get("ElapsedTime", 0)
+        source_size = volume_statistics.get("SourceFileSize", 0)
+        logger.info(
+            f"{volume_name}: {elapsed:.2f}s, {format_size(source_size)} read ({format_size(source_size / elapsed if elapsed > 0 else 0)}/s), {int(volume_statistics.get('NewFiles', 0))} new, {int(volume_statistics.get('ChangedFiles', 0))} changed and {int(volume_statistics.get('DeletedFiles', 0))} deleted files"
+        )
+
+
+def jobs_running() -> bool:
+    # Jobs are started with docker exec, they are the only other processes besides tini (PID 1)
+    try:
+        os.kill(-1, 0)
+        return True
+    except ProcessLookupError:
+        return False
+
+
+def keep_runner_alive():
+    # Keeps the runner container running between backups/restores (RUNNER_KEEP_ALIVE), see start_runner
+    try:
+        while True:
+            signal.pause()
+    except KeyboardInterrupt:
+        # NOTE: docker stop only signals this process, running jobs have to start their containers again
+        if jobs_running():
+            logger.info("Stopping running jobs")
+            os.kill(-1, signal.SIGTERM)
+        while jobs_running():
+            time.sleep(0.1)
+
+
+def record_peak_memory(command: str):
+    # NOTE: ru_maxrss is in KB, RUSAGE_CHILDREN only contains finished processes (duplicity)
+    for process, who in [
+        ("runner", resource.RUSAGE_SELF),
+        ("duplicity", resource.RUSAGE_CHILDREN),
+    ]:
+        record_metric(
+            "duplyvolume_runner_peak_rss_bytes",
+            {"command": command, "process": process},
+            resource.getrusage(who).ru_maxrss * 1024,
+        )
+
 
 async def backup_stage2(volume_map: dict[str, VolumeInfo]):
     async with aiodocker.Docker() as client:
         logger.info("Backup stage 2 started")
+        start_time = time.monotonic()
+        # Finished backups of this run, for the summary
+        backups: dict[str, ManifestVolume] = {}
+        unchanged_backups: dict[str, ManifestVolume] = {}
+        if config.skip_unchanged:
+            volume_map, unchanged_backups = await skip_unchanged_volumes(volume_map)
+
+        async def process_volume(volume_name: str) -> Optional[Continuation]:
+            volume_info = volume_map[volume_name]
+            backup = await prepare_backup(volume_name)
+            if not volume_info.get("snapshot", False):
+                await backup_volume(volume_name, volume_info, backup)
+                backups[volume_name] = backup
+                return None
+
+            snapshot_path = await take_snapshot(volume_name)
+
+            async def backup_snapshot():
+                try:
+                    await backup_volume(volume_name, volume_info, backup, snapshot_path)
+                finally:
+                    await remove_snapshot(snapshot_path)
+                backups[volume_name] = backup
+
+            # The containers can be started before the backup
+            return backup_snapshot
+
         try:
-            for volume_name, volume_info in volume_map.items():
-                # Start all containers which have not yet been started again, but exclude containers needed for the next backup
-                await start_containers(client, volume_info["used_by_containers"])
-                await stop_containers(client, volume_info["used_by_containers"])
-                logger.info(f"Backing up volume {volume_name}")
-                await do_backup(volume_name)
-                remove_older_than = volume_info.get(
-                    "remove_older_than", config.remove_older_than
-                )
-                remove_all_but_n_full = volume_info.get(
-                    "remove_all_but_n_full", config.remove_all_but_n_full
-                )
-                remove_all_inc_of_but_n_full = volume_info.get(
-                    "remove_all_inc_of_but_n_full", config.remove_all_inc_of_but_n_full
-                )
-                if (
-                    remove_older_than is not None
-                    or remove_all_but_n_full is not None
-                    or remove_all_inc_of_but_n_full is not None
-                ):
-                    logger.info(f"Removing old backups from volume {volume_name}")
-                    await do_remove(
-                        volume_name,
-                        remove_older_than,
-                        remove_all_but_n_full,
-                        remove_all_inc_of_but_n_full,
-                    )
+            await process_in_groups(
+                client,
+                {
+                    volume_name: volume_info["used_by_containers"]
+                    for volume_name, volume_info in volume_map.items()
+                },
+                config.backup_concurrency,
+                process_volume,
+                # NOTE: Not during restores, they have to stop containers to replace their data
+                run_hooks=True,
+            )
+            log_backup_summary(backups, time.monotonic() - start_time)
             logger.info("Backup stage 2 done")
         finally:
-            await start_containers(client)
-            logger.info("All containers are running again")
+            try:
+                await start_containers(client)
+                logger.info("All containers are running again")
+            finally:
+                # NOTE: One read-modify-write of the manifest per run, also if a later volume failed
+                if len(backups) > 0 or len(unchanged_backups) > 0:
+                    await record_backups({**unchanged_backups, **backups})
+                record_peak_memory("backup")
+
+
+async def restore_volume(volume_name: str):
+    logger.info(f"Restoring volume {volume_name}")
+    start_time = time.monotonic()
+    await do_restore(volume_name)
+    duration = time.monotonic() - start_time
+    record_phase(volume_name, "duplicity", duration)
+    record_metric(
+        "duplyvolume_restore_duration_seconds", {"volume": volume_name}, duration
+    )
 
 
-async def restore_stage2(volume_map: dict[str, list[str]]):
+async def restore_stage2(volume_map: dict[str, RestoreInfo]):
     async with aiodocker.Docker() as client:
         logger.info("Restore stage 2 started")
         try:
-            for volume_name, used_by_containers in volume_map.items():
-                # Start all containers which have not yet been started again, but exclude containers needed for the next restore
-                # TODO: It is problematic if a container is stopped/started multiple times because in-between it the volumes can change
-                await start_containers(client, used_by_containers)
-                await stop_containers(client, used_by_containers)
-                logger.info(f"Restoring volume {volume_name}")
-                await do_restore(volume_name)
+            await process_in_groups(
+                client,
+                {
+                    volume_name: restore_info["used_by_containers"]
+                    for volume_name, restore_info in volume_map.items()
+                },
+                config.restore_concurrency,
+                restore_volume,
+                {
+                    volume_name: restore_info["restore_priority"]
+                    for volume_name, restore_info in volume_map.items()
+                    if "restore_priority" in restore_info
+                },
+            )
             logger.info("Restore stage 2 done")
         finally:
             await start_containers(client)
             logger.info("All containers are running again")
+            record_peak_memory("restore")
@@ -1,5 +1,12 @@
+import asyncio
+import logging
 import socket
-from typing import TypedDict, NotRequired
+from fnmatch import fnmatchcase
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Iterable, Optional, TypedDict, TypeVar, NotRequired
+
+T = TypeVar("T")
 
 
 async def close_writer(writer):
@@ -17,11 +24,142 @@ async def close_writer(writer):
             pass
 
 
+async def gather_limited(limit: int, awaitables: Iterable[Awaitable[T]]) -> list[T]:
+    # Like asyncio.gather, but at most limit awaitables run at the same time
+    semaphore = asyncio.Semaphore(limit)
+
+    async def limited(awaitable: Awaitable[T]) -> T:
+        async with semaphore:
+            return await awaitable
+
+    return await asyncio.gather(*(limited(awaitable) for awaitable in awaitables))
+
+
 my_hostname = socket.gethostname()
 
 
+def format_size(size: float) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def match_selector(
+    volume_name: str, volume_labels: Optional[dict[str, str]], selector: str
+) -> bool:
+    if selector.startswith("label="):
+        key, separator, value = selector[len("label=") :].partition("=")
+        return (
+            volume_labels is not None
+            and key in volume_labels
+            and (separator == "" or volume_labels[key] == value)
+        )
+    return fnmatchcase(volume_name, selector)
+
+
+def match_selectors(
+    volume_name: str, volume_labels: Optional[dict[str, str]], selectors: list[str]
+) -> bool:
+    # Selectors are volume names, glob patterns (e.g. "myapp_*") or "label=<key>" or "label=<key>=<value>"
+    # A volume is selected if it matches any selector (or there are none) and no selector prefixed with "!"
+    include = [selector for selector in selectors if not selector.startswith("!")]
+    exclude = [selector[1:] for selector in selectors if selector.startswith("!")]
+    if any(
+        match_selector(volume_name, volume_labels, selector) for selector in exclude
+    ):
+        return False
+    return len(include) == 0 or any(
+        match_selector(volume_name, volume_labels, selector) for selector in include
+    )
+
+
+def has_label_selectors(selectors: list[str]) -> bool:
+    return any(selector.lstrip("!").startswith("label=") for selector in selectors)
+
+
 class VolumeInfo(TypedDict):
     remove_older_than: NotRequired[str]
     remove_all_but_n_full: NotRequired[int]
     remove_all_inc_of_but_n_full: NotRequired[int]
+    snapshot: NotRequired[bool]
+    used_by_containers: list[str]
+
+
+def group_volumes(
+    used_by_containers: dict[str, list[str]],
+    priorities: Optional[dict[str, int]] = None,
+) -> list[list[str]]:
+    # Volumes which share a container end up in the same group (connected components)
+    parents = {volume_name: volume_name for volume_name in used_by_containers.keys()}
+
+    def find(volume_name: str) -> str:
+        while parents[volume_name] != volume_name:
+            parents[volume_name] = parents[parents[volume_name]]
+            volume_name = parents[volume_name]
+        return volume_name
+
+    first_volume_of_container: dict[str, str] = {}
+    for volume_name, containers in used_by_containers.items():
+        for container_id in containers:
+            if container_id in first_volume_of_container:
+                parents[find(volume_name)] = find(
+                    first_volume_of_container[container_id]
+                )
+            else:
+                first_volume_of_container[container_id] = volume_name
+
+    def priority(volume_name: str) -> int:
+        return 0 if priorities is None else priorities.get(volume_name, 0)
+
+    groups: dict[str, list[str]] = {}
+    for volume_name in sorted(used_by_containers.keys(), key=priority, reverse=True):
+        groups.setdefault(find(volume_name), []).append(volume_name)
+    # Every container is only stopped while its own group is processed, so the order does not change the total downtime.
+    # Start with the groups with the highest priority, then with the largest groups to keep the whole run short if groups are processed in parallel.
+    return sorted(
+        groups.values(),
+        key=lambda group: (
+            max(priority(volume_name) for volume_name in group),
+            len(group),
+        ),
+        reverse=True,
+    )
+
+
+log_prefix: ContextVar[Optional[str]] = ContextVar("log_prefix", default=None)
+
+
+@contextmanager
+def prefix_logs(prefix: Optional[str]):
+    # NOTE: Context variables are copied into new tasks, so this also works for parallel tasks
+    token = log_prefix.set(prefix)
+    try:
+        yield
+    finally:
+        log_prefix.reset(token)
+
+
+def install_log_prefix():
+    # Prefix every log record created while prefix_logs is active
+    record_factory = logging.getLogRecordFactory()
+
+    def prefixed_record_factory(*args, **kwargs):
+        record = record_factory(*args, **kwargs)
+        prefix = log_prefix.get()
+        # NOTE: Journal, metrics and history messages of the runner are parsed by the control container
+        if prefix is not None and record.name not in {
+            f"{__package__}.journal",
+            f"{__package__}.metrics",
+            f"{__package__}.history",
+        }:
+            record.msg = f"[{prefix}] {record.msg}"
+        return record
+
+    logging.setLogRecordFactory(prefixed_record_factory)
+
+
+class RestoreInfo(TypedDict):
+    restore_priority: NotRequired[int]
     used_by_containers: list[str]
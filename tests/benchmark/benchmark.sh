@@ -0,0 +1,154 @@
+#!/bin/bash
+
+# Measures backups and restores of a synthetic volume end to end (stage 1 and stage 2)
+# NOTE: Not a test-* directory, run-all-tests.sh does not pick it up
+#
+# Environment variables:
+#   SHAPE         small-files (default), large-files or deep-tree
+#   COUNT         Files (small-files/large-files) or files per directory level (deep-tree)
+#   SIZE_KB       Size of every file in KB
+#   DEPTH         Directory levels of deep-tree
+#   CHANGE_COUNT  Files which are rewritten before every backup after the first one
+#   RUNS          Number of backups, the first one is a full backup
+#   TARGET        local (default) or s3 (MinIO, see docker-compose.s3.yaml)
+#   RESULTS       File the results are appended to (tab separated)
+
+set -euo pipefail
+
+SHAPE=${SHAPE:-small-files}
+case "$SHAPE" in
+    small-files)
+        COUNT=${COUNT:-10000}
+        SIZE_KB=${SIZE_KB:-4}
+        ;;
+    large-files)
+        COUNT=${COUNT:-4}
+        SIZE_KB=${SIZE_KB:-262144}
+        ;;
+    deep-tree)
+        COUNT=${COUNT:-10}
+        SIZE_KB=${SIZE_KB:-4}
+        ;;
+    *)
+        echo "Unknown shape $SHAPE"
+        exit 1
+        ;;
+esac
+DEPTH=${DEPTH:-50}
+CHANGE_COUNT=${CHANGE_COUNT:-0}
+RUNS=${RUNS:-3}
+TARGET=${TARGET:-local}
+RESULTS=${RESULTS:-benchmark-results.tsv}
+
+if [[ "$TARGET" == "s3" ]]; then
+    export COMPOSE_FILE=docker-compose.yaml:docker-compose.s3.yaml
+elif [[ "$TARGET" != "local" ]]; then
+    echo "Unknown target $TARGET"
+    exit 1
+fi
+
+# NOTE: common.sh does not build, the benchmark should not measure an old image
+docker compose build
+
+. ../common.sh
+
+# Unlike in tests, the logs of the control container would hide the results
+function cleanup() {
+    docker compose down -t 0 --volumes
+}
+
+echo "Creating $SHAPE data ($COUNT files of $SIZE_KB KB)"
+docker compose exec -e SHAPE=$SHAPE -e COUNT=$COUNT -e SIZE_KB=$SIZE_KB -e DEPTH=$DEPTH container1 sh -c '
+    set -e
+    create_files() {
+        i=0
+        while [ $i -lt $COUNT ]; do
+            # One directory per 1000 files, large directories are a different benchmark
+            mkdir -p $1/d$((i / 1000))
+            head -c $((SIZE_KB * 1024)) /dev/urandom > $1/d$((i / 1000))/f$i
+            i=$((i + 1))
+        done
+    }
+    if [ $SHAPE = deep-tree ]; then
+        directory=/volume1
+        level=0
+        while [ $level -lt $DEPTH ]; do
+            directory=$directory/l$level
+            mkdir -p $directory
+            create_files $directory
+            level=$((level + 1))
+        done
+    else
+        create_files /volume1
+    fi
+'
+
+function change_files() {
+    docker compose exec -e CHANGE_COUNT=$CHANGE_COUNT container1 sh -c '
+        find /volume1 -type f | head -n $CHANGE_COUNT | while read file; do
+            head -c `wc -c < $file` /dev/urandom > $file
+        done
+    '
+}
+
+function metric() {
+    # Sums all samples of a metric (e.g. of all volumes), labels can be part of the name
+    docker compose exec duplyvolume metrics | awk -v name="$1" '$1 == name || index($1, name "{") == 1 { sum += $2 } END { printf "%.3f", sum }'
+}
+
+function now() {
+    date +%s.%N
+}
+
+if [[ ! -f "$RESULTS" ]]; then
+    echo -e "date\trevision\tshape\tcount\tsize_kb\ttarget\trun\twall_s\tduplicity_s\tsource_mb\tmb_per_s\tdowntime_s\trunner_rss_mb\tduplicity_rss_mb" > "$RESULTS"
+fi
+REVISION=`git rev-parse --short HEAD 2>/dev/null || echo unknown`
+
+function megabytes() {
+    awk "BEGIN { printf \"%.1f\", $1 / 1048576 }"
+}
+
+function record() {
+    # Arguments: run, command (backup/restore), start and end time
+    local wall_time=`awk "BEGIN { printf \"%.2f\", $4 - $3 }"`
+    local duplicity_duration=`metric duplyvolume_$2_duration_seconds`
+    local source_bytes=`metric duplyvolume_backup_source_bytes`
+    local throughput=`awk "BEGIN { printf \"%.1f\", $duplicity_duration > 0 ? $source_bytes / 1048576 / $duplicity_duration : 0 }"`
+    local downtime=`metric duplyvolume_last_container_downtime_seconds`
+    local runner_rss=`metric "duplyvolume_runner_peak_rss_bytes{command=\"$2\",process=\"runner\"}"`
+    local duplicity_rss=`metric "duplyvolume_runner_peak_rss_bytes{command=\"$2\",process=\"duplicity\"}"`
+    echo -e "`date -Iseconds`\t$REVISION\t$SHAPE\t$COUNT\t$SIZE_KB\t$TARGET\t$1\t$wall_time\t$duplicity_duration\t`megabytes $source_bytes`\t$throughput\t$downtime\t`megabytes $runner_rss`\t`megabytes $duplicity_rss`" >> "$RESULTS"
+}
+
+for RUN in `seq 1 $RUNS`; do
+    if [[ $RUN -gt 1 && $CHANGE_COUNT -gt 0 ]]; then
+        change_files
+    fi
+    echo "Backup $RUN of $RUNS"
+    START=`now`
+    OUTPUT_BACKUP=`docker compose exec duplyvolume backup`
+    END=`now`
+    if [[ ! "$OUTPUT_BACKUP" =~ "Backup done" ]]; then
+        echo "Backup failed"
+        echo "$OUTPUT_BACKUP"
+        exit 1
+    fi
+    record backup-$RUN backup $START $END
+done
+
+echo "Restore"
+START=`now`
+OUTPUT_RESTORE=`docker compose exec duplyvolume restore`
+END=`now`
+if [[ ! "$OUTPUT_RESTORE" =~ "Restore done" ]]; then
+    echo "Restore failed"
+    echo "$OUTPUT_RESTORE"
+    exit 1
+fi
+record restore restore $START $END
+
+# The durations of every phase, as recorded by duplyvolume itself
+docker compose exec duplyvolume report
+
+column -t -s $'\t' "$RESULTS"
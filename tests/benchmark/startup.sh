@@ -0,0 +1,47 @@
+#!/bin/bash
+
+# Measures the import time of the duplyvolume modules and the time of a client command
+# Client commands like healthcheck run very often, they should not load the control or runner code
+# NOTE: Not a test-* directory, run-all-tests.sh does not pick it up
+#
+# Environment variables:
+#   RUNS  Number of client commands which are timed
+
+set -euo pipefail
+
+RUNS=${RUNS:-20}
+
+docker compose up -d --build duplyvolume
+
+function cleanup() {
+    docker compose down -t 0 --volumes
+}
+
+trap cleanup EXIT
+
+for i in {1..30}; do
+    if [[ `docker compose ps --format '{{.Status}}' duplyvolume` =~ ^Up\ .+\ \(healthy\)$ ]]; then
+        break
+    fi
+    sleep 1
+done
+
+function import_time() {
+    # Cumulative import time of a module in ms, see https://docs.python.org/3/using/cmdline.html#cmdoption-X
+    docker compose exec duplyvolume python3 -X importtime -c "import $1" 2>&1 | awk -F '|' -v name="$1" '{ gsub(/ /, "", $3) } $3 == name { printf "%.1f", $2 / 1000 }'
+}
+
+function loaded_modules() {
+    docker compose exec duplyvolume python3 -c "import sys, $1; print(' '.join(sorted(m for m in sys.modules if m.split('.')[0] in {'duplyvolume', 'aiodocker', 'apscheduler', 'pydantic', 'boto3', 'botocore'})))"
+}
+
+echo "Import times:"
+for MODULE in duplyvolume.main duplyvolume.control duplyvolume.runner_tasks; do
+    echo -e "$MODULE\t`import_time $MODULE` ms"
+done | column -t -s $'\t'
+
+echo "Modules loaded by the client commands: `loaded_modules duplyvolume.main`"
+
+echo "Running the metrics command $RUNS times:"
+# NOTE: metrics does not do anything in the control container, so this is the time of the client
+docker compose exec duplyvolume time sh -c "for i in \`seq 1 $RUNS\`; do metrics > /dev/null; done"
@@ -0,0 +1,56 @@
+#!/bin/bash
+
+set -euo pipefail
+
+export COMPOSE_FILE=../docker-compose.yaml:docker-compose.hooks.yaml
+
+. ../common.sh
+
+STARTED_AT=`docker inspect -f '{{.State.StartedAt}}' tests-container1-1`
+
+# duplyvolume.stop is false, the container keeps running and only the hooks run
+OUTPUT_BACKUP=`docker compose exec duplyvolume backup | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT_BACKUP" =~ `cat ./duplyvolume-backup-expected.txt` ]]; then
+    echo "Backup output is as expected"
+else
+    echo "Backup output is not as expected"
+    echo "$OUTPUT_BACKUP"
+    exit 1
+fi
+
+if [[ `docker inspect -f '{{.State.StartedAt}}' tests-container1-1` == "$STARTED_AT" ]]; then
+    echo "Container was not restarted"
+else
+    echo "Container was restarted"
+    exit 1
+fi
+
+# post_exec removed the dump again
+FILES=`docker compose exec container1 ls -A /volume1`
+if [[ "$FILES" == "" ]]; then
+    echo "Dump was removed"
+else
+    echo "Dump was not removed"
+    echo "$FILES"
+    exit 1
+fi
+
+# Restores stop the container and don't run hooks
+OUTPUT_RESTORE=`docker compose exec duplyvolume restore | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT_RESTORE" =~ `cat ./duplyvolume-restore-expected.txt` ]]; then
+    echo "Restore output is as expected"
+else
+    echo "Restore output is not as expected"
+    echo "$OUTPUT_RESTORE"
+    exit 1
+fi
+
+# The backup contains the dump of pre_exec
+FILE_CONTENTS=`docker compose exec container1 cat /volume1/dump`
+if [[ "$FILE_CONTENTS" == "value1" ]]; then
+    echo "Dump is as expected"
+else
+    echo "Dump is not as expected"
+    echo "$FILE_CONTENTS"
+    exit 1
+fi
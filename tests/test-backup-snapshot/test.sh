@@ -0,0 +1,51 @@
+#!/bin/bash
+
+set -euo pipefail
+
+export COMPOSE_FILE=../docker-compose.yaml:docker-compose.snapshot.yaml
+
+. ../common.sh
+
+# file2 is a hard link, the snapshot keeps it
+docker compose exec container1 sh -c "echo value1 > /volume1/file1 && ln /volume1/file1 /volume1/file2"
+
+# The container is started again right after the snapshot, before duplicity runs
+OUTPUT_BACKUP=`docker compose exec duplyvolume backup | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT_BACKUP" =~ `cat ./duplyvolume-backup-expected.txt` ]]; then
+    echo "Backup output is as expected"
+else
+    echo "Backup output is not as expected"
+    echo "$OUTPUT_BACKUP"
+    exit 1
+fi
+
+# The snapshot is removed after the backup
+SNAPSHOTS=`docker compose exec duplyvolume ls -A /snapshots-volume`
+if [[ "$SNAPSHOTS" == "" ]]; then
+    echo "Snapshot is removed"
+else
+    echo "Snapshot is not removed"
+    echo "$SNAPSHOTS"
+    exit 1
+fi
+
+docker compose exec container1 sh -c "echo value2 > /volume1/file1"
+
+OUTPUT_RESTORE=`docker compose exec duplyvolume restore | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT_RESTORE" =~ `cat ./duplyvolume-restore-expected.txt` ]]; then
+    echo "Restore output is as expected"
+else
+    echo "Restore output is not as expected"
+    echo "$OUTPUT_RESTORE"
+    exit 1
+fi
+
+# Check the backup of the snapshot has the content of the volume
+FILE_CONTENTS=`docker compose exec container1 cat /volume1/file1 /volume1/file2`
+if [[ "$FILE_CONTENTS" == $'value1\nvalue1' ]]; then
+    echo "Files are as expected"
+else
+    echo "Files are not as expected"
+    echo "$FILE_CONTENTS"
+    exit 1
+fi
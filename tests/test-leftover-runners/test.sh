@@ -0,0 +1,38 @@
+#!/bin/bash
+
+set -euo pipefail
+
+. ../common.sh
+
+trap "docker rm -f tests-runner-once tests-runner-pool > /dev/null 2>&1; cleanup" EXIT
+
+# Runners of an earlier duplyvolume container, only the label matters
+docker run -d --rm --name tests-runner-once --label duplyvolume.runner=once alpine:3.22 sleep infinity
+docker run -d --name tests-runner-pool --label duplyvolume.runner=pool alpine:3.22 sleep infinity
+
+docker compose restart duplyvolume
+wait_for_container duplyvolume '^Up .+ \(healthy\)$'
+
+# The kept runner is removed, the runner of a single backup/restore keeps running and the journal is not replayed
+OUTPUT=`docker compose logs --no-log-prefix duplyvolume | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT" =~ `cat ./duplyvolume-logs-expected.txt` ]]; then
+    echo "Output is as expected"
+else
+    echo "Output is not as expected"
+    echo "$OUTPUT"
+    exit 1
+fi
+
+if [[ `docker ps -q --filter name=tests-runner-once` != "" ]]; then
+    echo "Runner of a single backup is still running"
+else
+    echo "Runner of a single backup was removed"
+    exit 1
+fi
+
+if [[ `docker ps -aq --filter name=tests-runner-pool` == "" ]]; then
+    echo "Kept runner was removed"
+else
+    echo "Kept runner was not removed"
+    exit 1
+fi
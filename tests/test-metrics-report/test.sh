@@ -0,0 +1,53 @@
+#!/bin/bash
+
+set -euo pipefail
+
+. ../common.sh
+
+# Large enough that the metrics and the report are requested while the backup runs
+docker compose exec container1 sh -c "dd if=/dev/urandom of=/volume1/file1 bs=1M count=500 2> /dev/null"
+
+OUTPUT_REPORT=`docker compose exec duplyvolume report`
+if [[ "$OUTPUT_REPORT" == "No successful backup runs recorded yet" ]]; then
+    echo "Report without backups is as expected"
+else
+    echo "Report without backups is not as expected"
+    echo "$OUTPUT_REPORT"
+    exit 1
+fi
+
+docker compose exec duplyvolume backup > /dev/null &
+BACKUP_PID=$!
+
+# Log lines of the running backup must not end up in the metrics or the report
+while kill -0 $BACKUP_PID 2> /dev/null; do
+    for COMMAND in metrics report; do
+        OUTPUT_COMMAND=`docker compose exec duplyvolume $COMMAND`
+        if echo "$OUTPUT_COMMAND" | grep -qE "^(DEBUG|INFO|WARNING|ERROR|CRITICAL):"; then
+            echo "Output of $COMMAND contains log lines"
+            echo "$OUTPUT_COMMAND"
+            exit 1
+        fi
+    done
+    sleep 0.5
+done
+wait $BACKUP_PID
+echo "Metrics and report during the backup are as expected"
+
+OUTPUT_METRICS=`docker compose exec duplyvolume metrics`
+if [[ "$OUTPUT_METRICS" =~ `cat ./duplyvolume-metrics-expected.txt` ]]; then
+    echo "Metrics are as expected"
+else
+    echo "Metrics are not as expected"
+    echo "$OUTPUT_METRICS"
+    exit 1
+fi
+
+OUTPUT_REPORT=`docker compose exec duplyvolume report`
+if [[ "$OUTPUT_REPORT" =~ `cat ./duplyvolume-report-expected.txt` ]]; then
+    echo "Report is as expected"
+else
+    echo "Report is not as expected"
+    echo "$OUTPUT_REPORT"
+    exit 1
+fi
@@ -0,0 +1,40 @@
+#!/bin/bash
+
+set -euo pipefail
+
+export COMPOSE_FILE=../docker-compose.yaml:docker-compose.sync.yaml
+
+. ../common.sh
+
+docker compose exec container1 sh -c "echo value1 > /volume1/file1 && echo value1 > /volume1/file2 && touch -r /volume1/file1 /tmp/file1-time"
+
+OUTPUT_BACKUP=`docker compose exec duplyvolume backup | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT_BACKUP" =~ `cat ./duplyvolume-backup-expected.txt` ]]; then
+    echo "Backup output is as expected"
+else
+    echo "Backup output is not as expected"
+    echo "$OUTPUT_BACKUP"
+    exit 1
+fi
+
+# Same size and modification time as in the backup, only the content differs
+docker compose exec container1 sh -c "echo value2 > /volume1/file1 && touch -r /tmp/file1-time /volume1/file1 && echo value3 > /volume1/file3"
+
+OUTPUT_RESTORE=`docker compose exec duplyvolume restore | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT_RESTORE" =~ `cat ./duplyvolume-restore-expected.txt` ]]; then
+    echo "Restore output is as expected"
+else
+    echo "Restore output is not as expected"
+    echo "$OUTPUT_RESTORE"
+    exit 1
+fi
+
+# Check file1 is "value1" again, file2 is untouched and file3 is removed
+FILE_CONTENTS=`docker compose exec container1 sh -c "cat /volume1/file1 /volume1/file2; ls /volume1"`
+if [[ "$FILE_CONTENTS" == $'value1\nvalue1\nfile1\nfile2' ]]; then
+    echo "Files are as expected"
+else
+    echo "Files are not as expected"
+    echo "$FILE_CONTENTS"
+    exit 1
+fi
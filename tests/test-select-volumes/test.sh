@@ -0,0 +1,91 @@
+#!/bin/bash
+
+set -euo pipefail
+
+export COMPOSE_FILE=../docker-compose.yaml:docker-compose.volume2.yaml
+
+. ../common.sh
+
+docker compose exec container1 sh -c "echo value1 > /volume1/file1"
+
+# A selector which matches nothing must not stop any container
+OUTPUT_BACKUP=`docker compose exec duplyvolume backup label=nonexistent | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT_BACKUP" =~ `cat ./duplyvolume-backup-nothing-expected.txt` ]]; then
+    echo "Backup output is as expected"
+else
+    echo "Backup output is not as expected"
+    echo "$OUTPUT_BACKUP"
+    exit 1
+fi
+
+OUTPUT_BACKUP=`docker compose exec duplyvolume backup tests_volume1 | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT_BACKUP" =~ `cat ./duplyvolume-backup-expected.txt` ]]; then
+    echo "Backup output is as expected"
+else
+    echo "Backup output is not as expected"
+    echo "$OUTPUT_BACKUP"
+    exit 1
+fi
+
+docker compose exec container1 sh -c "echo value2 > /volume1/file1"
+
+OUTPUT_RESTORE=`docker compose exec duplyvolume restore "tests_*" | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT_RESTORE" =~ `cat ./duplyvolume-restore-expected.txt` ]]; then
+    echo "Restore output is as expected"
+else
+    echo "Restore output is not as expected"
+    echo "$OUTPUT_RESTORE"
+    exit 1
+fi
+
+# Check the file content is "value1" again
+FILE_CONTENTS=`docker compose exec container1 cat /volume1/file1`
+if [[ "$FILE_CONTENTS" == "value1" ]]; then
+    echo "File is as expected"
+else
+    echo "File is not as expected"
+    echo "$FILE_CONTENTS"
+    exit 1
+fi
+
+OUTPUT_BACKUP=`docker compose exec duplyvolume backup tests_volume2 | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT_BACKUP" =~ `cat ./duplyvolume-backup-volume2-expected.txt` ]]; then
+    echo "Backup output is as expected"
+else
+    echo "Backup output is not as expected"
+    echo "$OUTPUT_BACKUP"
+    exit 1
+fi
+
+# Pretend tests_volume1 was backed up a day later, so tests_volume2 has no recent backup
+docker compose exec duplyvolume python3 -c '
+import gzip, json
+from datetime import datetime, timedelta
+path = "/target/duplyvolume.manifest.json.gz"
+with open(path, "rb") as file:
+    manifest = json.loads(gzip.decompress(file.read()))
+volume = manifest["volumes"]["tests_volume1"]
+volume["last_backup"] = (datetime.fromisoformat(volume["last_backup"]) + timedelta(days=1)).isoformat()
+with open(path, "wb") as file:
+    file.write(gzip.compress(json.dumps(manifest).encode("utf8")))
+'
+
+# A glob must not restore volumes without recent backups
+OUTPUT_RESTORE=`docker compose exec duplyvolume restore "tests_*" | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT_RESTORE" =~ `cat ./duplyvolume-restore-window-expected.txt` ]]; then
+    echo "Restore output is as expected"
+else
+    echo "Restore output is not as expected"
+    echo "$OUTPUT_RESTORE"
+    exit 1
+fi
+
+# Volumes selected by their name are restored anyway
+OUTPUT_RESTORE=`docker compose exec duplyvolume restore tests_volume1 tests_volume2 | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT_RESTORE" =~ `cat ./duplyvolume-restore-named-expected.txt` ]]; then
+    echo "Restore output is as expected"
+else
+    echo "Restore output is not as expected"
+    echo "$OUTPUT_RESTORE"
+    exit 1
+fi
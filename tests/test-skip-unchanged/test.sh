@@ -0,0 +1,28 @@
+#!/bin/bash
+
+set -euo pipefail
+
+export COMPOSE_FILE=../docker-compose.yaml:docker-compose.skip.yaml
+
+. ../common.sh
+
+docker compose exec container1 sh -c "echo value1 > /volume1/file1"
+
+OUTPUT_BACKUP=`docker compose exec duplyvolume backup | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT_BACKUP" =~ `cat ./duplyvolume-backup-expected.txt` ]]; then
+    echo "Backup output is as expected"
+else
+    echo "Backup output is not as expected"
+    echo "$OUTPUT_BACKUP"
+    exit 1
+fi
+
+# Nothing changed and the full backup is recent, so the container is not stopped
+OUTPUT_BACKUP=`docker compose exec duplyvolume backup | grep -v "Healthcheck passed"`
+if [[ "$OUTPUT_BACKUP" =~ `cat ./duplyvolume-backup-unchanged-expected.txt` ]]; then
+    echo "Backup output is as expected"
+else
+    echo "Backup output is not as expected"
+    echo "$OUTPUT_BACKUP"
+    exit 1
+fi
@@ -0,0 +1,35 @@
+#!/bin/bash
+
+set -euo pipefail
+
+. ../common.sh
+
+function wait_for_log() {
+    for i in {1..10}; do
+        if docker compose logs --no-log-prefix duplyvolume | grep -q "$1"; then
+            return 0
+        fi
+        sleep 1
+    done
+    echo "$1 was not logged"
+    return 1
+}
+
+# The schedule is added as soon as the volume is created, without a restart
+docker volume create --label "duplyvolume.cron=0 4 * * *" tests_scheduled
+wait_for_log "Backup of volumes with schedule"
+
+# And removed with the last volume which uses it
+docker volume rm tests_scheduled
+wait_for_log "Removed backup schedule"
+
+# Check the full log
+OUTPUT=`docker compose logs --no-log-prefix duplyvolume | grep -v "Healthcheck passed"`
+
+if [[ "$OUTPUT" =~ `cat ./duplyvolume-logs-expected.txt` ]]; then
+    echo "Output is as expected"
+else
+    echo "Output is not as expected"
+    echo "$OUTPUT"
+    exit 1
+fi